@@ -103,6 +103,22 @@ class Acl(PluginInterface):
 		self.__loadUsers()
 		self.__loadGroups()
 
+	def getSnapshot(self):
+		"""
+		\brief Hand the loaded rights, users and groups to the restarted instance
+		"""
+		return {'rights' : self.rights, 'users' : self.users, 'groups' : self.groups}
+
+	def restoreSnapshot(self, args, snapshot):
+		"""
+		\brief Take over the rights, users and groups instead of loading them from the database
+		"""
+		self.__args = args
+		self.connection = MySQLdb.connect(user = args['user'], passwd = args['password'], db = args['db'])
+		self.rights = snapshot['rights']
+		self.users = snapshot['users']
+		self.groups = snapshot['groups']
+
 	def shutDown(self):
 		"""
 		\brief Closes the MySQL connection on shutdown
@@ -158,6 +174,7 @@ class Acl(PluginInterface):
 											db = self.__args['db'])
 		return self.connection.cursor(MySQLdb.cursors.DictCursor)
 
+	@cacheable(('Acl', 'userAdded'))
 	def getIdFromUserName(self, userName):
 		"""
 		\brief Transforms a userName to its id
@@ -278,6 +295,7 @@ class Acl(PluginInterface):
 			cursor.close()
 			self.connection.commit()
 			self.__loadUsers()
+			self.signalEvent('userAdded', userName)
 	
 	def userAddGroup(self, userName, groupName):
 		"""
@@ -0,0 +1,565 @@
+from PluginInterface import *
+from PluginManager import PluginManager
+from Manialink import *
+from multiprocessing import Pipe
+import cPickle
+import threading
+import time
+import sys
+import os
+import glob
+import shutil
+import tempfile
+import socket
+import struct
+import xmlrpclib
+import Queue
+import ForkServer
+import Gbx
+
+"""
+\file Benchmark.py
+\brief Micro-benchmarks for the plugin communication
+
+Run "python Benchmark.py" for all benchmarks or "python Benchmark.py <name> ..." for some of them.
+"""
+
+class LegacyFunction:
+	"""
+	\brief The function message as it was before the envelope, args pickled by hand
+	"""
+	def __init__(self, name, args):
+		self.name = name
+		self.args = cPickle.dumps(args)
+		self.questioner = None
+
+	def getArgs(self):
+		return cPickle.loads(self.args)
+
+class LegacyResult:
+	"""
+	\brief The result message as it was before the envelope, carrying its whole function
+	"""
+	def __init__(self, function, result):
+		self.function = function
+		self.value = cPickle.dumps(result)
+
+	def getValue(self):
+		return cPickle.loads(self.value)
+
+def __payloads():
+	"""
+	\brief Build typical payloads of the plugin communication
+	\return A list of (name, args) tuples
+	"""
+	chat = ('2', 'somelogin', '/records', False)
+	maps = [{'UId' : 'a' * 27, 'Name' : 'Map number ' + str(i), 'FileName' : 'Campaign/Map' + str(i) + '.Map.Gbx',
+			'Author' : 'nadeo', 'Environnement' : 'Stadium', 'GoldTime' : 30000 + i, 'CopperPrice' : 1000,
+			'LapRace' : False, 'NbLaps' : 0, 'NbCheckpoints' : 12} for i in xrange(500)]
+	root = Frame()
+	for i in xrange(30):
+		row = Frame()
+		for j in xrange(4):
+			label = Label()
+			label['text'] = 'cell ' + str(i) + '/' + str(j)
+			label['posn'] = str(j * 10) + ' ' + str(-i * 3) + ' 1'
+			row.addChild(label)
+		root.addChild(row)
+	return [('chat', chat), ('maplist', (maps, )), ('manialink', (root, 'Window.name', 'somelogin'))]
+
+def __measure(name, count, roundTrip):
+	"""
+	\brief Run the round trip count times and print cpu time and latency per message
+	"""
+	roundTrip()
+	wall = time.time()
+	cpu = time.clock()
+	for i in xrange(count):
+		roundTrip()
+	cpu = time.clock() - cpu
+	wall = time.time() - wall
+	print('{0:<30} {1:10.1f} us cpu/msg {2:10.1f} us latency/msg'.format(name,
+		cpu / (2 * count) * 1e6, wall / (2 * count) * 1e6))
+
+def benchmarkEnvelope(count = 200):
+	"""
+	\brief Compare the legacy pickling with the message envelope
+	\param count The number of round trips per payload
+
+	A caller sends a function call through a manager thread to a callee thread,
+	which answers with its args, the answer takes the way back.
+	This resembles one call between two plugins with the manager inbetween.
+	"""
+	count = int(count)
+	for payloadName, args in __payloads():
+		callerPipe, managerCallerPipe = Pipe()
+		managerCalleePipe, calleePipe = Pipe()
+
+		def legacyManager():
+			while True:
+				request = managerCallerPipe.recv()
+				if request is None:
+					managerCalleePipe.send(None)
+					return
+				request.name = request.name[1]
+				managerCalleePipe.send(request)
+				managerCallerPipe.send(managerCalleePipe.recv())
+
+		def legacyCallee():
+			while True:
+				request = calleePipe.recv()
+				if request is None:
+					return
+				calleePipe.send(LegacyResult(request, request.getArgs()))
+
+		def legacyRoundTrip():
+			callerPipe.send(LegacyFunction(('Callee', 'echo'), args))
+			callerPipe.recv().getValue()
+
+		threads = [threading.Thread(target = legacyManager), threading.Thread(target = legacyCallee)]
+		for t in threads:
+			t.start()
+		__measure('legacy ' + payloadName, count, legacyRoundTrip)
+		callerPipe.send(None)
+		for t in threads:
+			t.join()
+
+		def envelopeManager():
+			while True:
+				request = receiveMessage(managerCallerPipe)
+				if isinstance(request, Stop):
+					sendMessage(managerCalleePipe, request)
+					return
+				request.name = request.name[1]
+				sendMessage(managerCalleePipe, request)
+				sendMessage(managerCallerPipe, receiveMessage(managerCalleePipe))
+
+		def envelopeCallee():
+			while True:
+				request = receiveMessage(calleePipe)
+				if isinstance(request, Stop):
+					return
+				sendMessage(calleePipe, Result(request, request.getArgs()))
+
+		def envelopeRoundTrip():
+			function = Function(('Callee', 'echo'), args)
+			function.id = 1
+			sendMessage(callerPipe, function)
+			receiveMessage(callerPipe).getValue()
+
+		threads = [threading.Thread(target = envelopeManager), threading.Thread(target = envelopeCallee)]
+		for t in threads:
+			t.start()
+		__measure('envelope ' + payloadName, count, envelopeRoundTrip)
+		sendMessage(callerPipe, Stop())
+		for t in threads:
+			t.join()
+
+class DummyPlugin(PluginInterface):
+	"""
+	\brief A plugin that does nothing but calling its neighbour
+	"""
+	def __init__(self, pipes, args):
+		super(DummyPlugin, self).__init__(pipes)
+		self.__neighbour = args #The name of the plugin to call
+
+	def echo(self, value):
+		return value
+
+	def drive(self, count):
+		"""
+		\brief Call the neighbour count times and report to the manager when done
+
+		The calls are made from an extra thread as the worker has to answer the echos.
+		"""
+		def calls():
+			for i in xrange(count):
+				self.callFunction((self.__neighbour, 'echo'), i)
+			self.callMethod((None, 'benchmarkDone'))
+		threading.Thread(target = calls).start()
+
+class BenchmarkManager(PluginManager):
+	"""
+	\brief A PluginManager that counts the plugins that are done
+	"""
+	def __init__(self, router, preload = None):
+		super(BenchmarkManager, self).__init__(router, preload)
+		self.done = threading.Semaphore(0)
+
+	def benchmarkDone(self, caller):
+		self.done.release()
+
+def __dummyPlugins(count, imports = ''):
+	"""
+	\brief Write count plugin files derived from DummyPlugin into a temporary directory
+	\param imports Import statements to put at the top of each file
+	\return The directory and the list of file names
+	"""
+	directory = tempfile.mkdtemp()
+	sys.path.insert(0, directory)
+	fileNames = []
+	for i in xrange(count):
+		fileName = os.path.join(directory, 'Dummy' + str(i) + '.py')
+		with open(fileName, 'w') as f:
+			f.write(imports + 'from Benchmark import DummyPlugin\nclass Dummy{0}(DummyPlugin):\n\tpass\n'.format(i))
+		fileNames.append(fileName)
+	return directory, fileNames
+
+def __contextSwitches():
+	"""
+	\brief Sum the context switches of all threads of this process
+	"""
+	switches = 0
+	for status in glob.glob('/proc/self/task/*/status'):
+		try:
+			for line in open(status):
+				if 'ctxt_switches' in line:
+					switches += int(line.split()[-1])
+		except IOError:
+			pass
+	return switches
+
+def benchmarkRouter(calls = 200):
+	"""
+	\brief Compare two listener threads per plugin with the single router thread
+	\param calls The number of calls each plugin makes to its neighbour
+
+	Every plugin calls its neighbour, all plugins at the same time.
+	"""
+	calls = int(calls)
+	for count in (10, 50, 100):
+		directory, fileNames = __dummyPlugins(count)
+		for router in (False, True):
+			threads = threading.active_count()
+			manager = BenchmarkManager(router)
+			for i, fileName in enumerate(fileNames):
+				manager.loadPlugin(None, fileName, 'Dummy' + str((i + 1) % count))
+			threads = threading.active_count() - threads
+			switches = __contextSwitches()
+			wall = time.time()
+			cpu = time.clock()
+			for name in manager.plugins:
+				manager.plugins[name].pipes[0].send_bytes(Method('drive', (calls, )).encode())
+			for name in manager.plugins:
+				manager.done.acquire()
+			cpu = time.clock() - cpu
+			wall = time.time() - wall
+			switches = __contextSwitches() - switches
+			print('{0:3d} plugins {1:<8} {2:4d} manager threads {3:8.0f} calls/s {4:8.1f} us manager cpu/call '
+				'{5:6.2f} context switches/call'.format(count, router and 'router' or 'threads', threads,
+				count * calls / wall, cpu / (count * calls) * 1e6, float(switches) / (count * calls)))
+			for plugin in manager.plugins.values():
+				plugin.process.terminate()
+				plugin.process.join()
+			if router:
+				manager._PluginManager__router.stop()
+			time.sleep(0.5)
+		sys.path.remove(directory)
+		shutil.rmtree(directory)
+
+def __memory(pid):
+	"""
+	\brief Get the resident and the proportional set size of a process
+	\return The tuple (rss, pss) in kB
+	"""
+	sizes = {}
+	for line in open('/proc/' + str(pid) + '/smaps_rollup'):
+		fields = line.split()
+		if fields[0] in ('Rss:', 'Pss:'):
+			sizes[fields[0]] = int(fields[1])
+	return sizes['Rss:'], sizes['Pss:']
+
+def benchmarkSpawn(count = 15):
+	"""
+	\brief Compare fresh plugin processes with processes forked from the preloaded fork server
+	\param count The number of plugins, about the size of the full plugin set
+
+	Each plugin imports the modules the plugins of this package commonly use.
+	The cold start is the time from loading until all plugins returned from initialize,
+	the memory is summed over the plugin processes and the fork server.
+	"""
+	count = int(count)
+	modules = ['WindowElements', 'xmlrpclib', 'urllib2', 'BaseHTTPServer', 'Gbx']
+	directory, fileNames = __dummyPlugins(count, ''.join('import ' + m + '\n' for m in modules))
+	for preload in (None, ForkServer.defaultPreload + modules):
+		manager = BenchmarkManager(False, preload)
+		wall = time.time()
+		startup = manager.loadPlugins(None, [(fileName, None) for fileName in fileNames])
+		startup.wait()
+		wall = time.time() - wall
+		pids = set(plugin.process.pid for plugin in manager.plugins.values())
+		forkServer = manager._PluginManager__forkServer
+		if forkServer != None:
+			pids.add(forkServer._ForkServer__process.pid)
+		rss, pss = [sum(sizes) for sizes in zip(*[__memory(pid) for pid in pids])]
+		print('{0:3d} plugins {1:<11} {2:8.0f} ms cold start {3:8d} kB rss {4:8d} kB pss'.format(count, 
+			preload and 'fork server' or 'process', wall * 1e3, rss, pss))
+		for plugin in manager.plugins.values():
+			plugin.process.terminate()
+			plugin.process.join()
+		if forkServer != None:
+			forkServer.stop()
+	sys.path.remove(directory)
+	shutil.rmtree(directory)
+
+class GbxStandIn(object):
+	"""
+	\brief A local stand-in for the dedicated server that speaks GBXRemote 2
+
+	Every method call is answered with its params after the latency,
+	the server itself takes no time, like a dedicated server behind a network.
+	A system.multicall is answered with the params of each of its calls.
+	"""
+	def __init__(self, latency):
+		"""
+		\param latency The seconds from a request until its response is sent
+		"""
+		self.latency = latency
+		self.requests = 0 #The number of requests received
+		self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.__socket.bind(('127.0.0.1', 0))
+		self.__socket.listen(5)
+		self.address = '127.0.0.1:' + str(self.__socket.getsockname()[1]) #The address for Gbx.Client
+		thread = threading.Thread(target = self.__accept)
+		thread.daemon = True
+		thread.start()
+
+	def __accept(self):
+		while True:
+			connection = self.__socket.accept()[0]
+			responses = Queue.Queue() #The (due time, response) to send, in order
+			for target, args in ((self.__receive, (connection, responses)), (self.__respond, (connection, responses))):
+				thread = threading.Thread(target = target, args = args)
+				thread.daemon = True
+				thread.start()
+
+	def __read(self, connection, size):
+		data = ''
+		while len(data) < size:
+			chunk = connection.recv(size - len(data))
+			if chunk == '':
+				raise EOFError()
+			data += chunk
+		return data
+
+	def __receive(self, connection, responses):
+		connection.sendall(struct.pack('<L', 11) + 'GBXRemote 2')
+		try:
+			while True:
+				size, handle = struct.unpack('<LL', self.__read(connection, 8))
+				params, method = xmlrpclib.loads(self.__read(connection, size))
+				self.requests += 1
+				if method == 'system.multicall':
+					params = [[call['params']] for call in params[0]]
+				body = xmlrpclib.dumps((params, ), methodresponse = True)
+				responses.put((time.time() + self.latency, struct.pack('<LL', len(body), handle) + body))
+		except (EOFError, socket.error):
+			responses.put(None)
+
+	def __respond(self, connection, responses):
+		while True:
+			response = responses.get()
+			if response == None:
+				connection.close()
+				return
+			delay = response[0] - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			connection.sendall(response[1])
+
+def benchmarkGbx(calls = 100, latency = 0.002):
+	"""
+	\brief Compare lock-step GBXRemote requests with pipelined ones
+	\param calls The number of calls each of the threads makes
+	\param latency The seconds the stand-in server takes to answer
+
+	The threads stand for the workers of TmConnector, each serving another plugin.
+	The lock-step client is used by one thread at a time, as TmConnector did with a single worker.
+	"""
+	calls = int(calls)
+	server = GbxStandIn(float(latency))
+	for threads in (1, 8, 32):
+		for name, client, lock in (('lock-step', Gbx.Client(server.address), threading.Lock()),
+								('pipelined', Gbx.PipelinedClient(server.address), None)):
+			client.init()
+			def run():
+				for i in xrange(calls):
+					if lock != None:
+						lock.acquire()
+					try:
+						client.GetPlayerInfo('somelogin', i)
+					finally:
+						if lock != None:
+							lock.release()
+			workers = [threading.Thread(target = run) for i in xrange(threads)]
+			wall = time.time()
+			for worker in workers:
+				worker.start()
+			for worker in workers:
+				worker.join()
+			wall = time.time() - wall
+			print('{0:3d} threads {1:<10} {2:8.0f} calls/s {3:8.2f} ms latency/call'.format(threads, name,
+				threads * calls / wall, wall / calls * 1e3))
+			client.release()
+
+def benchmarkMulticall(calls = 200, latency = 0.002):
+	"""
+	\brief Compare a burst of calls to the dedicated server made one by one with one batched by Multicall
+	\param calls The number of calls in the burst, e.g. a manialink to every player
+	\param latency The seconds the stand-in server takes to answer
+
+	The burst is made by one thread without waiting for the results, 
+	like the method calls of one plugin that TmConnector processes in order.
+	"""
+	from TmConnector import Multicall
+	calls = int(calls)
+	server = GbxStandIn(float(latency))
+	client = Gbx.PipelinedClient(server.address)
+	client.init()
+	for name in ('single', 'multicall'):
+		requests = server.requests
+		wall = time.time()
+		if name == 'single':
+			for i in xrange(calls):
+				client.SendDisplayManialinkPageToLogin('login' + str(i), '<manialink/>', 0, False)
+		else:
+			multicall = Multicall(client)
+			futures = [multicall.call('SendDisplayManialinkPageToLogin', ('login' + str(i), '<manialink/>', 0, False))
+						for i in xrange(calls)]
+			for future in futures:
+				future.result()
+		wall = time.time() - wall
+		print('{0:<10} {1:8.1f} ms burst {2:5d} round trips'.format(name, wall * 1e3, server.requests - requests))
+	client.release()
+
+def __legacyReceive(connection):
+	"""
+	\brief Receive a GBXRemote 2 message as Gbx.Transport did before its receive buffer
+	\return The (handle, data) of the message
+	"""
+	def recv(size):
+		data = ''
+		while size > 0:
+			chunk = connection.recv(size)
+			if len(chunk) == 0:
+				raise socket.error('socket connection broken')
+			data += chunk
+			size -= len(chunk)
+		return data
+	size = struct.unpack('<L', recv(4))[0]
+	handle = struct.unpack('<L', recv(4))[0]
+	return handle, recv(size)
+
+def benchmarkReceive(count = 20000):
+	"""
+	\brief Compare the receive path of Gbx.Transport with the one before its receive buffer
+	\param count The number of callbacks in the checkpoint flood
+
+	A thread writes the messages into a socket as fast as it can, the other end receives them.
+	"""
+	count = int(count)
+	checkpoint = xmlrpclib.dumps(('somelogin', 'somelogin', 12345, 3, 7), 'TrackMania.PlayerCheckpoint')
+	mapList = xmlrpclib.dumps(([{'UId' : 'a' * 27, 'Name' : 'Map number ' + str(i), 
+								'FileName' : 'Campaign/Map' + str(i) + '.Map.Gbx', 'Author' : 'nadeo',
+								'Environnement' : 'Stadium', 'GoldTime' : 30000 + i, 'CopperPrice' : 1000}
+								for i in xrange(800)], ), methodresponse = True)
+	for name, body, messages in (('checkpoint flood', checkpoint, count), ('map list', mapList, 200)):
+		message = struct.pack('<LL', len(body), 0x80000000) + body
+		for receiver in ('legacy', 'buffered'):
+			reader, writer = socket.socketpair()
+			transport = Gbx.Transport()
+			transport.protocol = 2
+			transport.connection = reader
+			thread = threading.Thread(target = lambda: writer.sendall(message * messages))
+			wall = time.time()
+			cpu = time.clock()
+			thread.start()
+			for i in xrange(messages):
+				if receiver == 'legacy':
+					__legacyReceive(reader)
+				else:
+					transport._receive()
+			cpu = time.clock() - cpu
+			wall = time.time() - wall
+			thread.join()
+			reader.close()
+			writer.close()
+			print('{0:<16} {1:<8} {2:8.0f} messages/s {3:8.1f} MB/s {4:8.1f} us cpu/message'.format(name, receiver,
+				messages / wall, messages * len(message) / wall / 1e6, cpu / messages * 1e6))
+
+def __callbackPayload(name, params):
+	"""
+	\brief Format a callback the way the dedicated server sends it
+	\param name The name of the callback
+	\param params The list of (type, value) pairs of the parameters, with the XML of the value
+	\return The XML of the method call
+	"""
+	return ('<?xml version="1.0" encoding="UTF-8" ?>\n<methodCall>\n<methodName>' + name + '</methodName>\n<params>\n'
+			+ ''.join('<param><value><' + kind + '>' + value + '</' + kind + '></value></param>\n'
+					for kind, value in params) + '</params>\n</methodCall>')
+
+def __callbackPayloads():
+	"""
+	\brief The callbacks of a race as recorded from the dedicated server
+	\return A list of (name, XML) tuples
+	"""
+	playerInfo = ('<member><name>Login</name><value><string>somelogin</string></value></member>'
+				'<member><name>NickName</name><value><string>$s$f80Some$fffNick</string></value></member>'
+				'<member><name>PlayerId</name><value><i4>236</i4></value></member>'
+				'<member><name>TeamId</name><value><i4>-1</i4></value></member>'
+				'<member><name>SpectatorStatus</name><value><i4>0</i4></value></member>'
+				'<member><name>LadderRanking</name><value><i4>1532</i4></value></member>'
+				'<member><name>Flags</name><value><i4>0</i4></value></member>')
+	return [('PlayerCheckpoint', __callbackPayload('TrackMania.PlayerCheckpoint',
+				[('i4', '236'), ('string', 'somelogin'), ('i4', '25430'), ('i4', '0'), ('i4', '7')])),
+			('PlayerFinish', __callbackPayload('TrackMania.PlayerFinish',
+				[('i4', '236'), ('string', 'somelogin'), ('i4', '48210')])),
+			('PlayerChat', __callbackPayload('TrackMania.PlayerChat',
+				[('i4', '236'), ('string', 'somelogin'), ('string', '/records'), ('boolean', '1')])),
+			('PlayerChat utf-8', __callbackPayload('TrackMania.PlayerChat',
+				[('i4', '236'), ('string', 'somelogin'), ('string', '$f00gg w\xc3\xa4r sch\xc3\xb6n \xe2\x99\xa5'), 
+				('boolean', '0')])),
+			('PlayerChat entities', __callbackPayload('TrackMania.PlayerChat',
+				[('i4', '236'), ('string', 'somelogin'), ('string', '&lt;3 &amp; gg'), ('boolean', '0')])),
+			('PlayerInfoChanged', __callbackPayload('TrackMania.PlayerInfoChanged', [('struct', playerInfo)]))]
+
+def __typed(value):
+	"""
+	\brief Pair a decoded value with the types of all its parts, to compare decoders
+	"""
+	if isinstance(value, (list, tuple)):
+		return (type(value), [__typed(item) for item in value])
+	elif isinstance(value, dict):
+		return (type(value), sorted((__typed(key), __typed(item)) for key, item in value.items()))
+	return (type(value), repr(value))
+
+def benchmarkCallbacks(count = 20000):
+	"""
+	\brief Compare the callback decoder of Gbx with xmlrpclib.loads
+	\param count The number of times each callback is decoded
+
+	Before timing, the results of both decoders are checked to be identical, including the types.
+	"""
+	count = int(count)
+	for name, payload in __callbackPayloads():
+		expected = xmlrpclib.loads(payload)
+		if __typed(Gbx.loads(payload)) != __typed(expected):
+			raise AssertionError(name + ' decoded differently: ' + repr(Gbx.loads(payload)) + ' ' + repr(expected))
+		timings = []
+		for decode in (xmlrpclib.loads, Gbx.loads):
+			cpu = time.clock()
+			for i in xrange(count):
+				decode(payload)
+			timings.append((time.clock() - cpu) / count)
+		print('{0:<20} {1:8.1f} us xmlrpclib {2:8.1f} us Gbx {3:5.1f}x'.format(name,
+			timings[0] * 1e6, timings[1] * 1e6, timings[0] / timings[1]))
+
+if __name__ == '__main__':
+	benchmarks = dict([(name[len('benchmark'):], function) for name, function in globals().items()
+						if name.startswith('benchmark')])
+	if len(sys.argv) > 1:
+		benchmarks[sys.argv[1]](*sys.argv[2:])
+	else:
+		for name in sorted(benchmarks):
+			print('--- ' + name)
+			benchmarks[name]()
@@ -1,6 +1,7 @@
 from PluginInterface import *
 from Manialink import *
 from WindowElements import *
+import Metrics
 
 """
 \file ChatCommands.py
@@ -21,6 +22,13 @@ class ChatCommands(PluginInterface):
 		except KeyError:
 			pass
 	
+	@staticmethod
+	def getDependencies(args):
+		"""
+		\brief The plugins that have to be ready before this one is initialized
+		"""
+		return ['TmConnector', 'TmChat', 'Acl', 'ManialinkManager', 'Http', 'Maps']
+
 	def initialize(self, args):
 		"""
 		\brief Initialize the ChatCommands-plugin
@@ -78,8 +86,13 @@ class ChatCommands(PluginInterface):
 		
 		registerChatCommand('gg', 'chat_gg', 'Congratulate other players')
 
+		rightAdd('ChatCommands.perf', 'Display the performance metrics of the plugins.')
+		registerChatCommand('perf', 'chat_perf', 'Display message rate, waiting requests and the slowest handlers')
+
 		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'PlayerConnect', 'recordsReactor') 
+		self.subscribeState('Maps')
 		
+		#the dedicated server knows the connected players before Players published them
 		players = self.callFunction(('TmConnector', 'GetPlayerList'), 1000, 0)
 		for p in players:
 			self.recordsReactor(p['Login'], p['IsSpectator'])
@@ -730,17 +743,25 @@ class ChatCommands(PluginInterface):
 		\param args Additional arguments
 		"""
 		records = self.callFunction(('Records', 'getLocals'))
-		mapInstance = self.callFunction(('Maps', 'getCurrentMap'))
+		mapInstance = self.getState('Maps', 'currentMap')
+		if mapInstance == None:
+			#the copy of the state of Maps has not arrived yet
+			mapInstance = self.callFunction(('Maps', 'getCurrentMap'))
 		if len(records) == 0:
 			self.callMethod(('TmConnector', 'ChatSendServerMessageToLogin'),
 						'Currently there are no local records on this map.', login)
 		else:
+			nickNames = gather(*[self.callFunctionAsync(('Players', 'getPlayerNickname'), r['name'])
+								for r in records])
 			strings = [(
 						r['rank'],
 						'{:d}:{:2.3f}'.format(r['time'] // 60000, (r['time'] % 60000) / 1000.0),
-						self.callFunction(('Players', 'getPlayerNickname'), r['name'])
-					) for r in records]
-			window = TableStringsWindow('Local records on ' + mapInstance['Name'])
+						nickName
+					) for r, nickName in zip(records, nickNames)]
+			if mapInstance != None:
+				window = TableStringsWindow('Local records on ' + mapInstance['Name'])
+			else:
+				window = TableStringsWindow('Local records')
 			window.setSize((50, 70))
 			window.setPos((-25, 40))
 			window.setTableStrings(strings, 15, (5, 10, 30), ('Rank', 'Time', 'Name'))
@@ -762,6 +783,23 @@ class ChatCommands(PluginInterface):
 						'It seems the admin forgot the contact email address.',
 						login)
 			
+	def chat_perf(self, login, args):
+		"""
+		\brief Display a summary of the performance metrics
+		\param login The login of the calling player
+		\param args The number of handlers to list (optional)
+		"""
+		if not self.callFunction(('Acl', 'userHasRight'), login, 'ChatCommands.perf'):
+			self.callMethod(('TmConnector', 'ChatSendServerMessageToLogin'), 
+						'You do not have the right to display the metrics.', login)
+			return
+		try:
+			count = int(args)
+		except (TypeError, ValueError):
+			count = 5
+		lines = Metrics.summarize(Metrics.collect(self), count)
+		self.callMethod(('TmConnector', 'ChatSendServerMessageToLogin'), '\n'.join(lines), login)
+
 	def chat_gg(self, login, args):
 		"""
 		\brief Congratulate other players
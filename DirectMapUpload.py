@@ -22,6 +22,13 @@ class DirectMapUpload(PluginInterface):
         super(DirectMapUpload, self).__init__(pipes)
         self.__directUploadPath = 'direct_upload' #the name of the map folder for direct uploads
         
+    @staticmethod
+    def getDependencies(args):
+        """
+        \brief The plugins that have to be ready before this one is initialized
+        """
+        return ['TmChat', 'Acl', 'Http', 'Maps']
+
     def initialize(self, args):
         """
         \brief Initialize the instance
@@ -37,6 +44,7 @@ class DirectMapUpload(PluginInterface):
                         'Browse your directly uploaded maps.')
         self.callMethod(('Http', 'registerPath'), '/map/upload/', 
                         ('DirectMapUpload', 'web_upload'))
+        self.subscribeState('Maps')
     
     def web_upload(self, entries, login):
         """
@@ -239,16 +247,19 @@ class DirectMapUpload(PluginInterface):
         
         files.sort()
         
-        mapRotationFileNames = [i
-                                for i in self.callFunction(('TmConnector', 'GetMapList'), 100000, 0)]
+        mapRotationFileNames = [i['FileName'] for i in self.getState('Maps', 'mapList', [])]
         
         myMapsInRotation = filter(lambda i: os.path.relpath(personalMapPath + i , mapPath) 
                                             in mapRotationFileNames, files)
         myMapsOutRotation = filter(lambda i: os.path.relpath(personalMapPath + i , mapPath) 
                                             not in mapRotationFileNames, files)
         
+        mapIds = self.callMany([(('Maps', 'getMapIdFromUid'), 
+                                 (GBXChallengeFetcher.FetchChallenge(personalMapPath + m, True).uid, ))
+                                for m in myMapsOutRotation])
+        
         lines = []
-        for m in myMapsOutRotation:
+        for m, mapId in zip(myMapsOutRotation, mapIds):
             line = []
             nameLabel = Label()
             nameLabel['text'] = m
@@ -256,10 +267,7 @@ class DirectMapUpload(PluginInterface):
             
             commentsLabel = Label()
             commentsLabel['text'] = 'read'
-            commentsLabel.setCallback(('DirectMapUpload', 'cb_readComments'), 
-                        self.callFunction(('Maps', 'getMapIdFromUid'), 
-                        GBXChallengeFetcher.FetchChallenge(personalMapPath + m,
-                                                    True).uid))
+            commentsLabel.setCallback(('DirectMapUpload', 'cb_readComments'), mapId)
             line.append(commentsLabel)
             
             publishLabel = Label()
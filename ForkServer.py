@@ -0,0 +1,174 @@
+from multiprocessing import Process, Pipe
+from _multiprocessing import Connection, sendfd, recvfd
+import threading
+import cPickle
+import cStringIO
+import signal
+import errno
+import time
+import sys
+import os
+
+"""
+\file ForkServer.py
+\brief Starts plugin processes from a preloaded fork server
+
+The fork server is a small single threaded process that imports the modules all plugins need
+once and then forks a child for each plugin that is started.
+The children share the pages of these modules with the server copy-on-write
+and do not have to import them on their own, which makes starting a plugin a matter of milliseconds.
+"""
+
+defaultPreload = ['PluginInterface', 'Manialink', 'WindowElements', 'MySQLdb',
+				'xmlrpclib', 'urllib', 'urllib2', 'datetime'] #The modules most plugins import
+
+class ForkServer(object):
+	"""
+	\brief The manager side of the fork server
+	"""
+	def __init__(self, preload = None):
+		"""
+		\brief Start the fork server
+		\param preload The names of the modules to import in the server, None for defaultPreload
+
+		Create the server before any threads are started, it is forked from the calling process.
+		Modules that can not be imported are skipped.
+		"""
+		self.__connection, serverConnection = Pipe()
+		self.__lock = threading.Lock() #Serializes the requests to the server
+		self.__process = Process(target = serve, args = (serverConnection, self.__connection,
+								preload == None and defaultPreload or preload))
+		self.__process.daemon = True
+		self.__process.start()
+		serverConnection.close()
+
+	def start(self, target, args):
+		"""
+		\brief Run the target with the args in a new child of the server
+		\param target The function to run, it must be importable from its module
+		\param args The arguments to the function, connections among them are passed to the child
+		\return The process id of the child
+
+		The connections are closed in this process once the child has them.
+		"""
+		connections = []
+		def persistentId(obj):
+			if isinstance(obj, Connection):
+				connections.append(obj)
+				return str(len(connections) - 1)
+			return None
+		data = cStringIO.StringIO()
+		pickler = cPickle.Pickler(data, cPickle.HIGHEST_PROTOCOL)
+		pickler.persistent_id = persistentId
+		pickler.dump((target, args))
+		self.__lock.acquire()
+		try:
+			self.__connection.send_bytes(data.getvalue())
+			self.__connection.send(len(connections))
+			for connection in connections:
+				sendfd(self.__connection.fileno(), connection.fileno())
+			pid = self.__connection.recv()
+		finally:
+			self.__lock.release()
+		for connection in connections:
+			connection.close()
+		return pid
+
+	def stop(self):
+		"""
+		\brief Stop the server, the children keep running
+		"""
+		self.__connection.close()
+		self.__process.join()
+
+def serve(connection, managerConnection, preload):
+	"""
+	\brief The loop of the fork server
+	\param connection The connection to the ForkServer
+	\param managerConnection The other end of the connection, to be closed here
+	\param preload The names of the modules to import
+
+	The children are not waited for, SIGCHLD is ignored so that they are reaped by the system.
+	"""
+	managerConnection.close()
+	for name in preload:
+		try:
+			__import__(name)
+		except ImportError as e:
+			print('ForkServer could not preload ' + name + ': ' + str(e))
+	signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+	while True:
+		try:
+			data = connection.recv_bytes()
+			count = connection.recv()
+		except (EOFError, IOError):
+			return
+		fds = [recvfd(connection.fileno()) for i in xrange(count)]
+		pid = os.fork()
+		if pid == 0:
+			connection.close()
+			signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+			__runChild(data, fds)
+		for fd in fds:
+			os.close(fd)
+		connection.send(pid)
+
+def __runChild(data, fds):
+	"""
+	\brief Run the target in the forked child and exit
+	\param data The pickled (target, args)
+	\param fds The file descriptors of the connections in args
+	"""
+	exitCode = 1
+	try:
+		sys.stdin.close()
+		sys.stdin = open(os.devnull)
+		unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+		unpickler.persistent_load = lambda id: Connection(fds[int(id)])
+		target, args = unpickler.load()
+		target(*args)
+		exitCode = 0
+	except SystemExit as e:
+		exitCode = isinstance(e.code, int) and e.code or 1
+	except:
+		import traceback
+		traceback.print_exc()
+	finally:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os._exit(exitCode or 0)
+
+class ForkedProcess(object):
+	"""
+	\brief A plugin process started by the fork server
+
+	Behaves like a multiprocessing.Process as far as the PluginManager needs it.
+	The process is no child of this process, so joining it has to poll.
+	"""
+	def __init__(self, server, target, args):
+		self.__server = server #The ForkServer
+		self.__target = target
+		self.__args = args
+		self.pid = None #The process id once started
+
+	def start(self):
+		self.pid = self.__server.start(self.__target, self.__args)
+		self.__args = None
+
+	def is_alive(self):
+		if self.pid == None:
+			return False
+		try:
+			os.kill(self.pid, 0)
+		except OSError as e:
+			return e.errno != errno.ESRCH
+		return True
+
+	def join(self, timeout = None):
+		end = timeout != None and time.time() + timeout or None
+		while self.is_alive() and (end == None or time.time() < end):
+			time.sleep(0.01)
+
+	def terminate(self):
+		if self.is_alive():
+			os.kill(self.pid, signal.SIGTERM)
@@ -50,6 +50,13 @@ Trackmania Dedicated Server."""
 import xmlrpclib
 from xmlrpclib import Fault, Binary, DateTime
 import struct
+import re
+import socket
+import threading
+try:
+    from xml.parsers import expat
+except ImportError:
+    expat = None # callbacks are decoded without the expat decoder
 
 __version__ = '1.3'
 __author__ = 'Marck (marck00@bigfoot.com)'
@@ -74,6 +81,161 @@ class ConnectionError(ProtocolError):
     def __repr__(self):
         return "<ConnectionError %d: %s>" % (self.errcode, self.errmsg)
 
+#
+# Callback decoder
+#
+class _Unsupported(Exception):
+    """Raised by a callback decoder for messages it leaves to the next one."""
+    pass
+
+def _stringify(text):
+    # convert to 7-bit ascii if possible, like xmlrpclib does
+    try:
+        return text.encode('ascii')
+    except UnicodeError:
+        return text
+
+def _boolean(text):
+    if text == '0':
+        return False
+    elif text == '1':
+        return True
+    raise _Unsupported('bad boolean value') # xmlrpclib raises the error
+
+_scalars = {'string': _stringify, 'name': _stringify, 'i4': int, 'int': int,
+            'i8': int, 'double': float, 'boolean': _boolean}
+_structure = frozenset(['methodCall', 'methodName', 'params', 'param', 'value',
+                        'array', 'data', 'struct', 'member'])
+
+# a method call with a flat list of scalar parameters, as most callbacks are
+_flat_call = re.compile(
+    r'(?:<\?xml\s+version=(["\'])1\.0\1(?:\s+encoding=(["\'])[uU][tT][fF]-8\2)?\s*\?>)?'
+    r'\s*<methodCall>\s*<methodName>([^<]*)</methodName>\s*'
+    r'(?:<params>((?:\s*<param>\s*<value>(?:\s*<(i4|int|i8|string|boolean|double)>[^<]*</\5>\s*|[^<]*)'
+    r'</value>\s*</param>)*)\s*</params>\s*)?</methodCall>\s*\Z')
+_flat_value = re.compile(r'<value>(?:\s*<(i4|int|i8|string|boolean|double)>([^<]*)</\1>\s*|([^<]*))</value>')
+# anything the regular expressions can not decode like expat: characters
+# not allowed in XML, line ends to normalize and "]]>"
+_not_flat = re.compile(u'[^\t\n\x20-\ud7ff\ue000-\ufffd]')
+_entity = re.compile(u'&(lt|gt|amp|quot|apos);')
+_entities = {u'lt': u'<', u'gt': u'>', u'amp': u'&', u'quot': u'"', u'apos': u"'"}
+
+def _unescape(text):
+    if u'&' not in text:
+        return text
+    return _entity.sub(lambda entity: _entities[entity.group(1)], text)
+
+def _loads_flat(data):
+    """Decode a method call with only scalar parameters by regular
+    expressions, which saves the handler calls of expat for every element
+    and text. Return None for any other message."""
+    data = data.decode('utf-8')
+    if _not_flat.search(data) or u']]>' in data:
+        return None
+    # the predefined entities are decoded, character references left to expat
+    if u'&' in data and u'&' in _entity.sub(u'', data):
+        return None
+    call = _flat_call.match(data)
+    if not call:
+        return None
+    params = []
+    if call.group(4):
+        for kind, text, untyped in _flat_value.findall(call.group(4)):
+            if not kind or kind == 'string':
+                params.append(_stringify(_unescape(kind and text or untyped)))
+            elif kind == 'boolean':
+                params.append(_boolean(text))
+            elif kind == 'double':
+                params.append(float(text))
+            else:
+                params.append(int(text))
+    return tuple(params), _unescape(call.group(3)) or ''
+
+def _loads_expat(data):
+    """Decode an XML-RPC method call of the scalar, array and struct values
+    the dedicated server uses in its callbacks. Same events as the
+    Unmarshaller of xmlrpclib, but without its per-tag method dispatch."""
+    stack = [] # the decoded values
+    marks = [] # the start of the open arrays and structs in the stack
+    text = [] # the character data since the last start tag
+    state = [False, None, False] # untyped value open, method name, complete
+    scalars = _scalars
+
+    def start(tag, attrs):
+        if tag == 'array' or tag == 'struct':
+            marks.append(len(stack))
+        elif tag not in scalars and tag not in _structure:
+            raise _Unsupported(tag)
+        del text[:]
+        state[0] = tag == 'value'
+
+    def end(tag):
+        convert = scalars.get(tag)
+        if convert is not None:
+            stack.append(convert(''.join(text)))
+            state[0] = False
+        elif tag == 'value':
+            # a value without a type element is a string
+            if state[0]:
+                stack.append(_stringify(''.join(text)))
+                state[0] = False
+        elif tag == 'array':
+            mark = marks.pop()
+            stack[mark:] = [stack[mark:]]
+            state[0] = False
+        elif tag == 'struct':
+            mark = marks.pop()
+            items = stack[mark:]
+            members = {}
+            for i in range(0, len(items), 2):
+                members[_stringify(items[i])] = items[i+1]
+            stack[mark:] = [members]
+            state[0] = False
+        elif tag == 'params':
+            state[2] = True
+        elif tag == 'methodName':
+            state[1] = ''.join(text)
+            state[2] = True
+
+    parser = expat.ParserCreate(None, None)
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    parser.buffer_text = True
+    parser.Parse(data, True)
+    if not state[2] or marks:
+        raise _Unsupported('incomplete message')
+    return tuple(stack), state[1]
+
+_method_name = re.compile(r'<methodName>([^<&]*)</methodName>')
+
+def method_name(data):
+    """Return the method name of the XML-RPC method call in data without
+    decoding the call, or None if it can not be read that way."""
+    match = _method_name.search(data)
+    return match and match.group(1)
+
+_decoders = [_loads_flat] # the decoders tried before xmlrpclib
+_decode_errors = (_Unsupported, ValueError, IndexError)
+if expat is not None:
+    _decoders.append(_loads_expat)
+    _decode_errors += (expat.ExpatError, )
+
+def loads(data):
+    """Decode an XML-RPC message like xmlrpclib.loads() and return the tuple
+    (params, methodname). Flat callbacks are matched by regular expressions,
+    the others by an expat decoder tuned for their small method calls.
+    Everything else (faults, base64, dates, nil, malformed messages) goes to
+    xmlrpclib, so the results are the same."""
+    for decode in _decoders:
+        try:
+            result = decode(data)
+        except _decode_errors:
+            continue
+        if result is not None:
+            return result
+    return xmlrpclib.loads(data)
+
 #
 # Registry
 #
@@ -85,6 +247,7 @@ class Registry:
     def __init__(self):
         self._methods = {}
         self._default_method = None
+        self._filter = None
 
     def add_method(self, callback_name, method):
         """Add a method to the registry."""
@@ -98,6 +261,19 @@ class Registry:
         """Set a default method to handle otherwise unsupported requests."""
         self._default_method = method
 
+    def set_filter(self, accept):
+        """Set a function that gets the name of a callback and returns whether
+        to dispatch it. The callbacks it rejects are not even decoded. With
+        None, all callbacks are dispatched."""
+        self._filter = accept
+
+    def accepts(self, msg):
+        """Return False if the filter rejects the callback in the XML data msg."""
+        if self._filter is None:
+            return True
+        name = method_name(msg)
+        return name is None or self._filter(name)
+
     def dispatch(self, callback_name, params):
         """Dispatch an XML-RPC callback. There is no return value. The default
         method is called with the callback's name as first parameter. If there
@@ -122,6 +298,8 @@ class Transport(xmlrpclib.Transport):
     after the response has been received."""
 
     handle_mask = 0x80000000L
+    buffer_size = 65536 # size of the receive buffer, larger messages bypass it
+    max_message_size = 4*1024*1024 # larger sizes are taken for a broken connection
 
     def __init__(self, use_datetime=0):
         try:
@@ -132,6 +310,9 @@ class Transport(xmlrpclib.Transport):
         self.verbose = None
         self.protocol = None
         self.connection = None
+        self._buffer = bytearray(self.buffer_size) # the received bytes
+        self._start = 0 # the first unread byte in the buffer
+        self._end = 0 # the end of the received bytes in the buffer
 
     def _send(self, sock, data):
         data_len = len(data)
@@ -143,16 +324,67 @@ class Transport(xmlrpclib.Transport):
             total_sent += bytes_sent
 
     def _recv(self, sock, size):
-        data = ''
+        chunks = []
         while size > 0:
             chunk = sock.recv(size)
             chunk_len = len(chunk)
             if chunk_len == 0:
                 raise socket.error, "socket connection broken"
-            data += chunk
+            chunks.append(chunk)
             size -= chunk_len
+        return ''.join(chunks)
+
+    def _fill(self, size):
+        """Receive until the buffer holds at least size unread bytes. Each
+        recv takes as much as the socket offers, so one call may bring
+        several messages."""
+        if self._end - self._start >= size:
+            return
+        if self._start + size > len(self._buffer):
+            # move the unread bytes to the front
+            unread = self._buffer[self._start:self._end]
+            self._buffer[:len(unread)] = unread
+            self._start = 0
+            self._end = len(unread)
+        view = memoryview(self._buffer)
+        while self._end - self._start < size:
+            received = self.connection.recv_into(view[self._end:])
+            if received == 0:
+                raise socket.error, "socket connection broken"
+            self._end += received
+
+    def _take(self, size):
+        """Remove size bytes from the buffer and return them."""
+        # one copy, slicing the bytearray first would copy twice
+        data = memoryview(self._buffer)[self._start:self._start + size].tobytes()
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
         return data
 
+    def _take_large(self, size):
+        """Return a message larger than the buffer. Its start is taken from
+        the buffer, the rest is received directly, so the buffer keeps its
+        size."""
+        buffered = min(size, self._end - self._start)
+        chunks = [self._take(buffered)]
+        size -= buffered
+        while size > 0:
+            chunk = self.connection.recv(size)
+            if len(chunk) == 0:
+                raise socket.error, "socket connection broken"
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def _buffered(self):
+        """Return True if the buffer holds a complete message."""
+        header_size = self.protocol == 2 and 8 or 4
+        if self._end - self._start < header_size:
+            return False
+        size = struct.unpack_from('<L', self._buffer, self._start)[0]
+        return self._end - self._start >= header_size + size
+
     def request(self, host, handler, request_body, verbose=0):
         """Perform a gbx request."""
         if DEBUG: print "[Transport.request]"
@@ -192,6 +424,8 @@ class Transport(xmlrpclib.Transport):
                  raise ConnectionError(e[0], e[1])
         if protocol == "GBXRemote 1":
             self.protocol = 1
+            # the responses have no handle, _receive gives them this one
+            self.handle = self.__class__.handle_mask
         elif protocol == "GBXRemote 2":
             self.protocol = 2
             self.handle = 0x80000000L
@@ -203,22 +437,26 @@ class Transport(xmlrpclib.Transport):
         if verbose > 1:
             print "protocol version: GBXRemote", self.protocol
         self.connection = s
+        self._start = self._end = 0
 
-    def send_request(self, request_body):
-        """Send XML-RPC string."""
+    def send_request(self, request_body, handle=None):
+        """Send XML-RPC string. With protocol version 2 the request carries the
+        given handle, the current handle if there is none."""
         if DEBUG: print "[Transport.send_request]"
+        if handle == None:
+            handle = self.handle
         header = struct.pack('<L', len(request_body)) # Size of XML data
         if self.protocol == 2:
-            header += struct.pack('<L', self.handle) # Context handle
+            header += struct.pack('<L', handle) # Context handle
         if self.verbose > 1:
             text = "snd header: length=%d" % len(request_body)
             if self.protocol == 2:
-                text += " handle=0x%X" % self.handle
+                text += " handle=0x%X" % handle
             print text
-        self._send(self.connection, header)
         if self.verbose:
             print "snd body:", repr(request_body)
-        self._send(self.connection, request_body)
+        # one write, a separate header would wait for the acknowledgement (Nagle)
+        self._send(self.connection, header + request_body)
 
     def parse_response(self):
         """Receive and parse response and handle any callbacks."""
@@ -233,20 +471,25 @@ class Transport(xmlrpclib.Transport):
 
     def _receive(self):
         """Receive message from server."""
-        header = self._recv(self.connection, 4)
-        size = struct.unpack('<L', header)[0] # Size of XML data
         if self.protocol == 1:
+            self._fill(4)
+            size = struct.unpack_from('<L', self._buffer, self._start)[0] # Size of XML data
             handle = self.__class__.handle_mask
+            self._start += 4
         elif self.protocol == 2:
-            # Context handle
-            handle = struct.unpack('<L', self._recv(self.connection, 4))[0]
+            # Size of XML data and context handle
+            self._fill(8)
+            size, handle = struct.unpack_from('<LL', self._buffer, self._start)
+            self._start += 8
             if self.verbose > 1:
                 print "rcv header: handle=0x%X" % handle
-        if (handle == 0 or size == 0 or size > 256*1024):
+        if (handle == 0 or size == 0 or size > self.max_message_size):
             raise ProtocolError('', xmlrpclib.PARSE_ERROR,
                  'transport error - connection interrupted.')
-        data = self._recv(self.connection, size)
-        return handle, data
+        if size > len(self._buffer):
+            return handle, self._take_large(size)
+        self._fill(size)
+        return handle, self._take(size)
 
     def _handle_callback(self, handle, msg):
         """Handle callbacks. Return True for an actual callback, otherwise False."""
@@ -290,7 +533,9 @@ class TrackmaniaTransport(Transport):
             raise ProtocolError('', xmlrpclib.TRANSPORT_ERROR,
                  'transport error - client not initialized.')
         self.verbose = verbose
-        if timeout == None:
+        if self._buffered():
+            incoming = True
+        elif timeout == None:
             incoming, outgoing, errornous = select.select([self.connection], [], [self.connection])
         else:
             incoming, outgoing, errornous = select.select([self.connection], [], [self.connection], timeout)
@@ -298,6 +543,10 @@ class TrackmaniaTransport(Transport):
         if incoming:
             handle, msg = self._receive()
             result = self._handle_callback(handle, msg)
+            # the messages that arrived with the same recv need no further select
+            while self._buffered():
+                handle, msg = self._receive()
+                result = self._handle_callback(handle, msg) or result
         return result
 
     def _handle_callback(self, handle, msg):
@@ -307,7 +556,9 @@ class TrackmaniaTransport(Transport):
             # this is a callback, not our response!
             if self.verbose:
                 print "rcv body:", repr(msg)
-            params, name = xmlrpclib.loads(msg)
+            if not self.registry.accepts(msg):
+                return True
+            params, name = loads(msg)
             self.registry.dispatch(name, params)
             return True
         else:
@@ -342,12 +593,144 @@ class AlternativeTransport(TrackmaniaTransport):
             # just add it to the message list for the user to read.
             if self.verbose:
                 print "rcv body:", repr(msg)
-            params, name = xmlrpclib.loads(msg)
+            params, name = loads(msg)
             self.callbacks.append([name] + list(params))
             return True
         else:
             return False
 
+class PipelinedTransport(TrackmaniaTransport):
+    """Handles XML-RPC transactions to a Trackmania Dedicated Server with many
+    requests in flight at once. Each request gets its own handle, a reader
+    thread receives the responses in whatever order they arrive and wakes the
+    thread that waits for the handle. Callbacks are relayed to registered
+    methods by the reader thread. Requests may be made from several threads.
+    With protocol version 1 there are no handles, the requests are made one
+    after another, also those made with send."""
+
+    def __init__(self):
+        TrackmaniaTransport.__init__(self)
+        self.pending = {}   # the [event, response, error] of each request in flight by handle
+        self.lock = threading.Lock() # guards the handles and the pending requests
+        self.send_lock = threading.Lock() # keeps the header and the body of a request together
+        self.reader = None
+        self.error = None   # the error that ended the connection
+
+    def connect(self, host, handler, verbose=0):
+        TrackmaniaTransport.connect(self, host, handler, verbose)
+        self.error = None
+        if self.protocol == 2:
+            self.reader = threading.Thread(target=self._read)
+            self.reader.daemon = True
+            self.reader.start()
+
+    def request(self, host, handler, request_body, verbose=0):
+        if DEBUG: print "[%s.request]" % self.__class__.__name__
+        self.verbose = verbose
+        if not self.connection:
+            raise ConnectionError(xmlrpclib.TRANSPORT_ERROR, "Not connected")
+        if self.protocol == 1:
+            self.send_lock.acquire()
+            try:
+                self.send_request(request_body)
+                return self.parse_response()
+            finally:
+                self.send_lock.release()
+        return self.send(request_body)()
+
+    def send(self, request_body):
+        """Send a request without waiting for its response. Returns the
+        function that waits for the response and returns it parsed. With
+        protocol version 1 the response is waited for before this returns."""
+        if not self.connection:
+            raise ConnectionError(xmlrpclib.TRANSPORT_ERROR, "Not connected")
+        if self.protocol == 1:
+            response = self.request(None, None, request_body, self.verbose)
+            return lambda: response
+        waiter = [threading.Event(), None, None]
+        self.lock.acquire()
+        try:
+            if self.error:
+                raise self.error
+            if not self.reader or not self.reader.is_alive():
+                raise ConnectionError(xmlrpclib.TRANSPORT_ERROR,
+                                      "No reader for the responses")
+            handle = self.handle
+            # the handles of responses have the highest bit set, callbacks have it cleared
+            self.handle = handle < 0xFFFFFFFFL and handle + 1 or self.__class__.handle_mask
+            self.pending[handle] = waiter
+        finally:
+            self.lock.release()
+        self.send_lock.acquire()
+        try:
+            self.send_request(request_body, handle)
+        except socket.error, e:
+            self._fail(ConnectionError(xmlrpclib.TRANSPORT_ERROR, str(e)))
+        finally:
+            self.send_lock.release()
+        def wait():
+            waiter[0].wait()
+            if waiter[2]:
+                raise waiter[2]
+            if self.verbose:
+                print "rcv body:", repr(waiter[1])
+            return self._parse(waiter[1])
+        return wait
+
+    def _read(self):
+        """Receive the responses and callbacks until the connection ends."""
+        try:
+            while True:
+                handle, msg = self._receive()
+                if self._handle_callback(handle, msg):
+                    continue
+                self.lock.acquire()
+                waiter = self.pending.pop(handle, None)
+                self.lock.release()
+                if waiter:
+                    waiter[1] = msg
+                    waiter[0].set()
+        except (socket.error, ProtocolError), e:
+            self._fail(isinstance(e, ProtocolError) and e or
+                       ConnectionError(xmlrpclib.TRANSPORT_ERROR, str(e)))
+        except Exception, e:
+            # e.g. a callback that could not be decoded or relayed, nobody
+            # would read the responses after it
+            self._fail(ConnectionError(xmlrpclib.TRANSPORT_ERROR,
+                                       "reader failed: %r" % e))
+
+    def _fail(self, error):
+        """End all requests in flight with the error."""
+        self.lock.acquire()
+        try:
+            self.error = error
+            for waiter in self.pending.values():
+                waiter[2] = error
+                waiter[0].set()
+            self.pending.clear()
+        finally:
+            self.lock.release()
+
+    def wait_callback(self, timeout=None, verbose=0):
+        """The reader thread relays the callbacks as they arrive, so this only
+        waits until the connection ends or the timeout passed. Returns False."""
+        if self.reader:
+            self.reader.join(timeout)
+        return False
+
+    def disconnect(self):
+        if DEBUG: print "[PipelinedTransport.disconnect]"
+        if self.connection:
+            try:
+                # wakes the reader thread
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        Transport.disconnect(self)
+        if self.reader:
+            self.reader.join()
+            self.reader = None
+
 #
 # Server proxies
 #
@@ -448,6 +831,11 @@ class Client(_BaseClient):
         """Set a default method to handle otherwise unsupported callbacks."""
         self._ServerProxy__transport.registry.set_default_method(method)
 
+    def set_callback_filter(self, accept):
+        """Set a function that gets the name of a callback and returns whether
+        to handle it, the others are skipped before they are decoded."""
+        self._ServerProxy__transport.registry.set_filter(accept)
+
     def tick(self, timeout=None):
         """Wait for and process any callbacks for at most the specified period of time.
         The timeout value is specified as a floating point number in seconds.
@@ -455,6 +843,24 @@ class Client(_BaseClient):
         wait forever."""
         self._ServerProxy__transport.wait_callback(timeout, self._ServerProxy__verbose)
 
+class PipelinedClient(Client):
+    """Access an XML-RPC server with "gbx" protocol from several threads,
+    their requests are in flight at the same time.
+    Callback handling is done by registered methods in the reader thread."""
+
+    def __init__(self, address=__default_address__, verbose=0):
+        _BaseClient.__init__(self, address, PipelinedTransport(), verbose)
+
+    def send_multicall(self, calls):
+        """Send a list of (method name, params) calls as one system.multicall
+        without waiting for the response. Returns the function that waits for
+        the list of results, each a list with the value or a fault dict."""
+        request_body = xmlrpclib.dumps(([{'methodName' : name, 'params' : params}
+                                         for name, params in calls], ),
+                                       'system.multicall')
+        wait = self._ServerProxy__transport.send(request_body)
+        return lambda: wait()[0]
+
 #
 # Test procedures
 #
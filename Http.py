@@ -8,6 +8,7 @@ import time
 import urllib2
 import math
 import ManiaConnect
+import Metrics
 from xml.sax.saxutils import escape
 from Cookie import BaseCookie
 
@@ -31,6 +32,14 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
 		self.wfile.write(manialink)
 		
 	def do_GET(self):
+		if self.path == '/metrics':
+			#for monitoring, does not need a session
+			content = self.server.plugin.getMetricsText()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.end_headers()
+			self.wfile.write(content)
+			return
 		try:
 			sessionId = BaseCookie(self.headers['Cookie'])['session'].value
 		except KeyError:
@@ -108,6 +117,13 @@ class Http(PluginInterface):
 		"""
 		return 'http://' + str(self.__address[0]) + ':' + str(self.__address[1])
 		
+	def getMetricsText(self):
+		"""
+		\brief Get the metrics of the PluginManager and all plugins
+		\return The metrics in the Prometheus text format
+		"""
+		return Metrics.formatPrometheus(Metrics.collect(self))
+
 	def getUploadToken(self, callback, *args):
 		"""
 		\brief Generates a valid token for direct http uploads
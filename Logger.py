@@ -27,6 +27,9 @@ class Logger(PluginInterface):
 			self.file = open("logger.log", "w")
 		self.loglevel = 0
 		super(Logger, self).__init__(pipes)
+		#rather lose old lines than the memory of the server when the disk can not keep up
+		self.setQueuePolicy('log', 10000, QueuePolicy.DROP_OLDEST)
+		self.setPriority('log', Priority.BULK)
 
 	def initialize(self, args):
 		"""
@@ -25,6 +25,13 @@ class ManialinkManager(PluginInterface):
 		self.displays = {}
 		super(ManialinkManager, self).__init__(pipes)
 
+	@staticmethod
+	def getDependencies(args):
+		"""
+		\brief The plugins that have to be ready before this one is initialized
+		"""
+		return ['TmConnector', 'TmChat']
+
 	def initialize(self, args):
 		"""
 		\brief Initializing the manager instance
@@ -41,6 +41,13 @@ class Maps(PluginInterface):
 		self.__playerDict = {} #a dictionary that contains the index mapping of the tracks per user
 		super(Maps, self).__init__(pipes)
 
+	@staticmethod
+	def getDependencies(args):
+		"""
+		\brief The plugins that have to be ready before this one is initialized
+		"""
+		return ['TmConnector', 'TmChat', 'Acl', 'Karma']
+
 	def initialize(self, args):
 		"""
 		\brief Initialize the plugin on startup
@@ -152,7 +159,32 @@ class Maps(PluginInterface):
 		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'MapListModified', 'onMapListModified')
 		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'BeginMap', 'onBeginMap')
 		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'PlayerDisconnect', 'onPlayerDisconnect')
+		self.callMethod((None, 'enableSingleFlight'), 'getCurrentMap')
 		
+	def getSnapshot(self):
+		"""
+		\brief Hand the map list, the jukebox and the settings to the restarted instance
+		"""
+		return {'currentMaps' : self.__currentMaps, 
+				'currentMap' : self.__currentMap,
+				'nextMap' : self.__nextMap,
+				'matchSettingsFileName' : self.__matchSettingsFileName,
+				'jukebox' : self.__jukebox,
+				'playerDict' : self.__playerDict}
+
+	def restoreSnapshot(self, args, snapshot):
+		"""
+		\brief Take over the state of the previous instance instead of fetching the map list again
+		"""
+		self.__args = args
+		self.__connection = MySQLdb.connect(user = args['user'], passwd = args['password'], db = args['db'])
+		self.__currentMaps = snapshot['currentMaps']
+		self.__currentMap = snapshot['currentMap']
+		self.__nextMap = snapshot['nextMap']
+		self.__matchSettingsFileName = snapshot['matchSettingsFileName']
+		self.__jukebox = snapshot['jukebox']
+		self.__playerDict = snapshot['playerDict']
+
 	def __getCursor(self):
 		"""
 		\brief A helper function that returns a dict cursor to the MySQLdb
@@ -188,6 +220,17 @@ class Maps(PluginInterface):
 			dbInsertMaps) 
 		cursor.close()
 		self.__connection.commit()
+		self.signalEvent('mapListUpdated')
+		self.publishState('mapList', self.__currentMaps)
+		self.__publishCurrentMap()
+		
+	def __publishCurrentMap(self):
+		"""
+		\brief Share the current and the next map with the plugins that replicate the state of this plugin
+		"""
+		self.publishState('currentMap', self.__currentMap)
+		self.publishState('currentMapId', self.getMapIdFromUid(self.__currentMap['UId']))
+		self.publishState('nextMap', self.__nextMap)
 		
 	def __getMapPath(self):
 		"""
@@ -222,6 +265,7 @@ class Maps(PluginInterface):
 		"""
 		return self.__currentMap
 	
+	@cacheable(('Maps', 'mapListUpdated'))
 	def getMapIdFromUid(self, uid):
 		"""
 		\brief Map from an uid to a mapId in database
@@ -351,6 +395,7 @@ class Maps(PluginInterface):
 			self.__getMapListFromServer()
 		self.__currentMap = self.__currentMaps[CurMapIndex]
 		self.__nextMap = self.__currentMaps[NextMapIndex]
+		self.__publishCurrentMap()
 			
 	def chat_removethis(self, login, params):
 		"""
@@ -887,14 +932,18 @@ class Maps(PluginInterface):
 						commentsWindow, preserveState)
 	
 	def __prepareComments(self, comments, login, depth = 0):
-		canDeleteOwn = self.callFunction(('Acl', 'userHasRight'), login, 'Maps.deleteOwnComments')
-		canDeleteOthers = self.callFunction(('Acl', 'userHasRight'), login, 'Maps.deleteOthersComments')
-		canEditOwn = self.callFunction(('Acl', 'userHasRight'), login, 'Maps.editOwnComments')
-		canEditOthers = self.callFunction(('Acl', 'userHasRight'), login, 'Maps.editOthersComments')
-		canReply = self.callFunction(('Acl', 'userHasRight'), login, 'Maps.replyComment')
-		canVote = self.callFunction(('Acl', 'userHasRight'), login, 'Maps.voteComment')
+		hasRight = lambda right: self.callFunctionAsync(('Acl', 'userHasRight'), login, right)
+		(canDeleteOwn, canDeleteOthers, canEditOwn, 
+			canEditOthers, canReply, canVote) = gather(hasRight('Maps.deleteOwnComments'),
+													hasRight('Maps.deleteOthersComments'),
+													hasRight('Maps.editOwnComments'),
+													hasRight('Maps.editOthersComments'),
+													hasRight('Maps.replyComment'),
+													hasRight('Maps.voteComment'))
+		nickNames = gather(*[self.callFunctionAsync(('Players', 'getPlayerNickname'), i[2]) 
+							for i in comments])
 		output = []
-		for i in comments:
+		for i, nickName in zip(comments, nickNames):
 			if i[2] == login:
 				#the comment is mine
 				votable = False #Can not vote on own comment
@@ -915,7 +964,7 @@ class Maps(PluginInterface):
 						'editable' : editable,
 						'deletable' : deletable,
 						'answerable' : answerable,
-						'nickName' : self.callFunction(('Players', 'getPlayerNickname'), i[2]),
+						'nickName' : nickName,
 						'commentTuple' : i}
 			#append the answers to this comment
 			output.extend(self.__prepareComments(i[5], login, depth + 1))
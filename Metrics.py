@@ -0,0 +1,163 @@
+import threading
+import bisect
+import time
+
+"""
+\file Metrics.py
+\brief Counters and histograms of the plugin communication
+
+Every plugin and the PluginManager keep a Metrics instance.
+Its snapshots are plain dicts, so they can be passed between the processes
+and merged for the Prometheus text format.
+"""
+
+latencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) #In seconds
+sizeBuckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576) #In bytes
+
+class Metrics(object):
+	"""
+	\brief The counters and histograms of one process
+
+	A metric is identified by its name and its labels, a tuple of (label, value) pairs.
+	"""
+	def __init__(self):
+		self.started = time.time() #When the collection started
+		self.__counters = {} #The value of each counter by (name, labels)
+		self.__histograms = {} #The [bucket bounds, bucket counts, sum, count] by (name, labels)
+		self.__lock = threading.Lock()
+
+	def count(self, name, labels, value = 1):
+		"""
+		\brief Increase a counter
+		\param name The name of the counter
+		\param labels The tuple of (label, value) pairs
+		\param value The amount to add
+		"""
+		key = (name, labels)
+		self.__lock.acquire()
+		self.__counters[key] = self.__counters.get(key, 0) + value
+		self.__lock.release()
+
+	def observe(self, name, labels, value, buckets = latencyBuckets):
+		"""
+		\brief Add a value to a histogram
+		\param name The name of the histogram
+		\param labels The tuple of (label, value) pairs
+		\param value The observed value
+		\param buckets The upper bounds of the buckets, used when the histogram is new
+		"""
+		key = (name, labels)
+		self.__lock.acquire()
+		try:
+			histogram = self.__histograms.get(key)
+			if histogram == None:
+				histogram = self.__histograms[key] = [buckets, [0] * (len(buckets) + 1), 0, 0]
+			histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+			histogram[2] += value
+			histogram[3] += 1
+		finally:
+			self.__lock.release()
+
+	def snapshot(self, gauges = ()):
+		"""
+		\brief Copy the current values
+		\param gauges Additional ((name, labels), value) pairs of values that are measured right now
+		\return The dict with the 'counters', 'histograms' and 'gauges' by (name, labels) and 'uptime'
+		"""
+		self.__lock.acquire()
+		try:
+			return {'counters' : dict(self.__counters),
+					'histograms' : dict((key, (h[0], list(h[1]), h[2], h[3]))
+										for key, h in self.__histograms.items()),
+					'gauges' : dict(gauges),
+					'uptime' : time.time() - self.started}
+		finally:
+			self.__lock.release()
+
+def __formatLabels(labels, extra = ()):
+	"""
+	\brief Format the labels of a sample
+	"""
+	labels = tuple(labels) + tuple(extra)
+	if len(labels) == 0:
+		return ''
+	return '{' + ','.join('{0}="{1}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+						for label, value in labels) + '}'
+
+def formatPrometheus(snapshots):
+	"""
+	\brief Format snapshots in the Prometheus text format
+	\param snapshots The snapshots of several Metrics, the same metric may not appear in two of them
+	\return The text
+	"""
+	samples = {} #The lines of each metric by name
+	types = {} #The type of each metric by name
+	for snapshot in snapshots:
+		for kind, values in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+			for (name, labels), value in values.items():
+				types[name] = kind
+				samples.setdefault(name, []).append(name + __formatLabels(labels) + ' ' + repr(value))
+		for (name, labels), (buckets, counts, total, count) in snapshot['histograms'].items():
+			types[name] = 'histogram'
+			lines = samples.setdefault(name, [])
+			cumulative = 0
+			for bound, bucketCount in zip(tuple(buckets) + ('+Inf',), counts):
+				cumulative += bucketCount
+				lines.append(name + '_bucket' + __formatLabels(labels, (('le', bound),)) + ' ' + str(cumulative))
+			lines.append(name + '_sum' + __formatLabels(labels) + ' ' + repr(total))
+			lines.append(name + '_count' + __formatLabels(labels) + ' ' + str(count))
+	text = []
+	for name in sorted(samples):
+		text.append('# TYPE ' + name + ' ' + types[name])
+		text.extend(sorted(samples[name]))
+	return '\n'.join(text) + '\n'
+
+def collect(plugin, timeout = 5):
+	"""
+	\brief Collect the snapshots of the PluginManager and of all plugins
+	\param plugin The calling PluginInterface, which must not be one of its workers waiting for itself
+	\param timeout The seconds to wait for each snapshot
+	\return The list of snapshots, without those of plugins that did not answer in time
+	"""
+	from PluginInterface import Timeout
+	names = plugin.callFunction((None, 'PluginList'), timeout = timeout)
+	futures = ([plugin.callFunctionAsync((None, 'getMetrics'), timeout = timeout)]
+			+ [plugin.callFunctionAsync((name, 'getMetrics'), timeout = timeout) 
+				for name in names if name != plugin.name])
+	snapshots = [plugin.getMetrics()]
+	for future in futures:
+		try:
+			snapshots.append(future.result())
+		except Timeout:
+			#a stuck plugin must not stall the others, its timeout is counted in the calling plugin
+			pass
+	return snapshots
+
+def summarize(snapshots, count = 5):
+	"""
+	\brief Summarize snapshots in a few lines of text
+	\param snapshots The snapshots of the PluginManager and the plugins
+	\param count The number of handlers to list
+	\return The list of lines: the message rate, the waiting requests and the slowest handlers
+	"""
+	messages = 0
+	uptime = 0
+	waiting = []
+	handlers = []
+	for snapshot in snapshots:
+		for (name, labels), value in snapshot['counters'].items():
+			if name == 'tmc_messages_total':
+				messages += value
+				uptime = max(uptime, snapshot['uptime'])
+		for (name, labels), value in snapshot['gauges'].items():
+			if name == 'tmc_queue_depth' and value > 0:
+				waiting.append(dict(labels)['plugin'] + ' ' + str(value))
+		for (name, labels), (buckets, counts, total, calls) in snapshot['histograms'].items():
+			if name == 'tmc_handler_seconds':
+				labels = dict(labels)
+				handlers.append((total / calls, labels['plugin'] + '.' + str(labels['method']), calls))
+	lines = ['{0:.1f} messages/s'.format(uptime and messages / uptime or 0),
+			'Waiting requests: ' + (', '.join(waiting) or 'none')]
+	for mean, name, calls in sorted(handlers, reverse = True)[:count]:
+		lines.append('{0} {1:.1f} ms avg, {2} calls'.format(name, mean * 1e3, calls))
+	return lines
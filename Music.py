@@ -4,6 +4,13 @@ class Music(PluginInterface):
 	def __init__(self, pipes, args):
 		super(Music, self).__init__(pipes)
 
+	@staticmethod
+	def getDependencies(args):
+		"""
+		\brief The plugins that have to be ready before this one is initialized
+		"""
+		return ['TmConnector', 'TmChat']
+
 	def initialize(self, args):
 		self.songs = args
 		self.current = 0
@@ -20,6 +20,13 @@ class Players(PluginInterface):
 		self.playerList = {}
 		super(Players, self).__init__(pipes)
 
+	@staticmethod
+	def getDependencies(args):
+		"""
+		\brief The plugins that have to be ready before this one is initialized
+		"""
+		return ['TmConnector', 'TmChat', 'Acl']
+
 	def initialize(self, args):
 		"""
 		\brief Initialize the plugin
@@ -32,7 +39,7 @@ class Players(PluginInterface):
 		self.__checkTables()
 		self.__loadCurrentPlayers()
 		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'PlayerConnect', 'onPlayerConnect')
-		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'PlayerDisonnect', 'onPlayerDisconnect') 
+		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'PlayerDisconnect', 'onPlayerDisconnect') 
 		self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'EndMap', 'onEndMap')
 		self.callMethod(('TmChat', 'registerChatCommand'), 'players', 
 					('Players', 'chat_players'), 
@@ -41,6 +48,20 @@ class Players(PluginInterface):
 					'Is the player allowed to stay on the server on connection?')
 		
 
+	def getSnapshot(self):
+		"""
+		\brief Hand the list of connected players to the restarted instance
+		"""
+		return self.playerList
+
+	def restoreSnapshot(self, args, snapshot):
+		"""
+		\brief Take over the list of connected players instead of querying the server and the database
+		"""
+		self.__args = args
+		self.connection = MySQLdb.connect(user = args['user'], passwd = args['password'], db = args['db'])
+		self.playerList = snapshot
+
 	def __getCursor(self):
 		"""
 		\brief Get a cursor for this connection
@@ -97,6 +118,7 @@ class Players(PluginInterface):
 		info = self.playerList[login]
 		cursor = self.__getCursor()
 		cursor.execute('UPDATE `users` SET `nick`=%s, `UpdatedAt`=NOW() WHERE `name`=%s', (info['NickName'], login) )
+		self.signalEvent('playerUpdated', login)
 		groups = self.callFunction(('Acl', 'userGetGroups'), login)
 		if len(groups) == 0:
 			message = '$zNew Player: '
@@ -162,6 +184,7 @@ class Players(PluginInterface):
 						(40, 60), (-20, 30), rows, 15, (25, 15), ('Nickname', 'Login'))
 			
 
+	@cacheable(('Players', 'playerUpdated'))
 	def getPlayerNickname(self, playerName):
 		"""
 		\brief Get the nickname of the given playerlogin
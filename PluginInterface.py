@@ -1,29 +1,128 @@
-import imp,threading,os,cPickle
+import imp,threading,thread,os,cPickle,itertools,struct,collections,time,traceback
+from Metrics import Metrics
+from Tracing import Tracer, newSpanId
 
-def loadPlugin(fileName, pipes, args):
+def importPlugin(fileName):
+	"""
+	\brief Import the plugin class from its file
+	\param fileName The file name of the plugin, the class has the name of the file
+	\return The plugin class
+	"""
 	pluginPath,name = os.path.split(fileName)
 	className = os.path.splitext(name)[0]
 	os.chdir(pluginPath)
 	pluginModule = __import__(className)	
-	pluginClass = getattr(pluginModule, className)
-	if pipes[0].recv():
+	return getattr(pluginModule, className)
+
+def loadPlugin(fileName, pipes, args):
+	pluginClass = importPlugin(fileName)
+	options = pipes[0].recv()
+	if options:
 		pluginInstance = pluginClass(pipes, args)
+		if options.get('traceFile'):
+			pluginInstance.startTracing(options['traceFile'])
 		pluginInstance.run()
 
+def loadPluginGroup(plugins, pipes):
+	"""
+	\brief Run several plugins in this process
+	\param plugins The list of (fileName, args) of the plugins
+	\param pipes The communication pipes of the group to the PluginManager
+	"""
+	pluginClasses = [(importPlugin(fileName), args) for fileName, args in plugins]
+	options = pipes[0].recv()
+	if options:
+		group = PluginGroup(pipes)
+		for pluginClass, args in pluginClasses:
+			member = pluginClass(group, args)
+			if options.get('traceFile'):
+				member.startTracing(options['traceFile'])
+		group.run()
+
 
 class PluginInterface(object):
-	def __init__(self, pipes):
+	LISTENED = 'listenedEvents:' #The name of the pushes of the events of this plugin that have listeners
+
+	def __init__(self, pipes, workers = 1, orderingKey = None):
+		"""
+		\brief Set up the communication and the workers of the plugin
+		\param pipes The communication pipes to the PluginManager
+		\param workers The number of worker threads that process the requests to this plugin
+		\param orderingKey A function that maps a request (Function or Method) to a key,
+			requests with the same key are processed one after another in the order they arrived,
+			requests with different keys or the key None may be processed in parallel
+
+		With more than one worker the plugin has to synchronize its state itself
+		and should not share one database connection between the workers.
+		"""
+		self.name = self.__class__.__name__ #The name of this plugin
+		self.__group = None #The PluginGroup this plugin runs in
+		if isinstance(pipes, PluginGroup):
+			self.__group = pipes
+			pipes.members[self.name] = self
+			pipes = pipes.pipes
 		self.inPipe = pipes[0]
 		self.outPipe = pipes[1]
-		self.queue = []
-		self.hasWork = threading.Condition()
-		self.workerThread = threading.Thread(target=self.__work)
+		self.queues = [collections.deque() for i in xrange(Priority.LEVELS)] #The waiting jobs by priority
+		self.__queueLock = threading.RLock() #Guards the queue and the states of the workers
+		self.hasWork = threading.Condition(self.__queueLock)
+		self.__nestedWork = threading.Condition(self.__queueLock) #Wakes the workers that wait for a nested call
+		self.__waitingTraces = {} #The number of workers waiting for a nested call, by trace id
+		self.__syncWaits = 0 #The number of workers waiting for the first push of a subscribed state
+		self.workerThreads = [threading.Thread(target=self.__work) for i in xrange(workers)]
+		self.answerThread = threading.Thread(target=self.__receiveAnswers)
 		self.__running = False
-		self.__questioner = None
+		self.__orderingKey = orderingKey
+		self.__busyKeys = set() #The ordering keys of the requests that are processed right now
+		self.__local = threading.local() #The state of the request each worker processes
+		if self.__group != None:
+			self.__answerLock = self.__group.answerLock
+			self.__sendLock = self.__group.sendLock
+		else:
+			self.__answerLock = threading.Lock() #Serializes the answers of several workers on inPipe
+			self.__sendLock = threading.Lock() #Serializes the writes of several threads to outPipe
+		#a restarted instance must not reuse the ids of the calls its predecessor left waiting,
+		#their late answers would be taken for answers to its own calls
+		self.__callIds = itertools.count(struct.unpack('<L', os.urandom(4))[0] >> 2 or 1) #The source of the ids of function calls
+		self.__pending = {} #The calls that wait for their result, by call id
+		self.__pendingLock = threading.Lock()
+		self.__queuePolicies = {} #The QueuePolicy of each request name, None for the whole plugin
+		self.__priorities = {} #The Priority of the requests to each method or function of this plugin
+		self.metrics = Metrics() #The metrics of this plugin
+		self.__tracer = None #The Tracer that records the spans of the processed requests, if tracing
+		self.__cache = CallCache(1000) #The results of cacheable functions of other plugins
+		self.__replica = StateReplica() #The copies of the state other plugins publish
+		self.__listenedEvents = None #The names of the events of this plugin that have listeners, None until known
+		self.callTimeout = None #The default timeout of the function calls of this plugin in seconds, None to wait forever
 	
 	def initialize(self, args):
 		pass
 
+	def startTracing(self, fileName):
+		"""
+		\brief Record the spans of the requests this plugin processes
+		\param fileName The trace file the PluginManager created
+		"""
+		self.__tracer = Tracer(fileName, self.name)
+
+	def getSnapshot(self):
+		"""
+		\brief Get the in-memory state to hand to the new instance when this plugin is restarted
+		\return The picklable state or None to initialize the new instance from scratch
+		"""
+		return None
+
+	def restoreSnapshot(self, args, snapshot):
+		"""
+		\brief Start with the state of the previous instance instead of initialize
+		\param args The startup arguments, as for initialize
+		\param snapshot The state getSnapshot of the previous instance returned
+
+		The event subscriptions of the previous instance are kept by the PluginManager,
+		so this must not subscribe again.
+		"""
+		self.initialize(args)
+
 	@staticmethod
 	def getDependencies(args):
 		return []
@@ -34,47 +133,628 @@ class PluginInterface(object):
 
 	def run(self):
 		self.__running = True
-		self.workerThread.deamon = True
-		self.workerThread.start()
+		for worker in self.workerThreads:
+			worker.deamon = True
+			worker.start()
+		if self.__group != None:
+			#the group receives for all its members
+			return
+		self.answerThread.daemon = True
+		self.answerThread.start()
 		while self.__running:
 			try:
-				task = self.inPipe.recv()
-				self.hasWork.acquire()
-				self.queue.append(task)
-				self.hasWork.notify()
-				self.hasWork.release()
+				task = receiveMessage(self.inPipe)
+				self._enqueue(task)
+				if isinstance(task, Stop):
+					#the process ends when run returns, the waiting jobs are processed first
+					#and still receive the calls back into them
+					while self._working():
+						if self.inPipe.poll(0.05):
+							self._enqueue(receiveMessage(self.inPipe))
+					self._joinWorkers()
+					break
+			except (EOFError, IOError):
+				#the PluginManager is gone
+				self._enqueue(Stop())
+				break
 			except KeyboardInterrupt:
 				self.__stop()
 			except Exception as e:
 				print(self, e)
+
+	def _working(self):
+		"""
+		\brief Is a worker still processing the jobs before the Stop?
+		"""
+		return any(worker.is_alive() for worker in self.workerThreads)
+
+	def _joinWorkers(self):
+		"""
+		\brief Wait until the workers have processed the jobs before the Stop and ended
+
+		The requests that arrived after the Stop and were not processed are answered with an Error.
+		"""
+		for worker in self.workerThreads:
+			worker.join()
+		self.hasWork.acquire()
+		left = [job for queue in self.queues for job in queue]
+		for queue in self.queues:
+			queue.clear()
+		self.hasWork.release()
+		for job in left:
+			if not isinstance(job, Stop):
+				self.__reject(job, Error('Plugin ' + self.name + ' stopped'))
+
+	def _enqueue(self, task, control = False):
+		"""
+		\brief Put a request into the queue of the workers
+		\param task The request
+		\param control Is it a request of the system that must not wait for room, e.g. a state callback
+		"""
+		if isinstance(task, Function) and isinstance(task.name, tuple):
+			task.name = task.name[1]
+		if isinstance(task, Method) and task.name.startswith(CallCache.CALLBACK):
+			#invalidate right away instead of after the waiting requests
+			self.__cache.invalidate(self.__cache.callbacks.get(task.name))
+			return
+		if isinstance(task, Method) and task.name == PluginInterface.LISTENED:
+			#apply right away, so no event is dropped that is signalled after the subscription arrived
+			self.__listenedEvents = frozenset(task.getArgs()[0])
+			return
+		if isinstance(task, Method) and task.name.startswith(StateReplica.UPDATE):
+			#apply right away, so the workers read the new state before they process the requests after it
+			plugin, action, key, value = task.getArgs()
+			callback = task.name[len(StateReplica.UPDATE):]
+			for changed in self.__replica.apply(plugin, action, key, value):
+				if callback:
+					self._enqueue(LocalMethod(callback, (plugin, changed), task.questioner, task.priority), True)
+			return
+		task.orderingKey = None
+		task.queuePolicy = None
+		task.received = time.time()
+		if isinstance(task, Function) and self.__orderingKey != None:
+			#a Batch too, so it does not overtake the single calls of the same key
+			task.orderingKey = self.__orderingKey(task)
+		if isinstance(task, Function) and not isinstance(task, Batch):
+			task.priority = self.__priorities.get(task.name, task.priority)
+			task.queuePolicy = self.__queuePolicies.get(task.name, self.__queuePolicies.get(None))
+		self.hasWork.acquire()
+		try:
+			if control or self.__waitingTraces.get(getattr(task, 'traceId', 0)):
+				#a waiting job may depend on it, so it goes past the queue policy
+				task.queuePolicy = None
+			policy = task.queuePolicy
+			if policy != None and not policy.admit(task, self.__mayBlock):
+				return
+			self.queues[task.priority].append(task)
+			self.hasWork.notify()
+			if self.__waitingTraces.get(getattr(task, 'traceId', 0)):
+				self.__nestedWork.notify_all()
+			for dropped in policy and policy.evict() or ():
+				self.queues[dropped.priority].remove(dropped)
+				self.__reject(dropped, Error('Request ' + self.name + '.' + str(dropped.name) 
+											+ ' dropped by the queue policy'))
+		finally:
+			self.hasWork.release()
+
+	def setQueuePolicy(self, name, limit, policy = None, key = None):
+		"""
+		\brief Bound the number of waiting requests
+		\param name The name of the method or function the policy applies to, 
+			None for all requests that have no policy of their own
+		\param limit The number of requests that may wait, None for no limit
+		\param policy What happens to further requests: QueuePolicy.BLOCK, QueuePolicy.DROP_OLDEST 
+			or QueuePolicy.COALESCE, blocking is the default
+		\param key A function that maps a request to its key for QueuePolicy.COALESCE,
+			e.g. orderByArgument(1) keeps only the latest PlayerCheckpoint of each login
+
+		Blocking stops reading the pipe of this plugin, so the PluginManager and 
+		in the end the producer slow down to the pace of this plugin.
+		Only new requests wait and only while no worker waits for the result of a call,
+		because the requests that result depends on may follow in the pipe.
+		In a PluginGroup only the requests to this member wait, the other members go on.
+		Dropped function calls are answered with an Error.
+		"""
+		self.__queuePolicies[name] = QueuePolicy(limit, policy or QueuePolicy.BLOCK, key, self.__queueLock)
+
+	def __mayBlock(self):
+		"""
+		\brief May a new request wait for room in the queue? Called with the lock of the queue held
+		\return False while a worker waits for something that arrives through the pipe
+		"""
+		return not self.__waitingTraces and self.__syncWaits == 0
+
+	def __wakeBlocked(self):
+		"""
+		\brief Let the requests that wait for room in, a worker started to wait for the pipe
+		"""
+		for policy in self.__queuePolicies.values():
+			policy.wake()
+
+	def setPriority(self, name, priority):
+		"""
+		\brief Set the priority of the requests to a method or function of this plugin
+		\param name The name of the method or function
+		\param priority The Priority, e.g. Priority.BULK for work nobody waits for
+
+		Without this the requests keep the priority of the job they were made from.
+		"""
+		self.__priorities[name] = priority
+
+	def getMetrics(self):
+		"""
+		\brief Get the metrics of this plugin
+		\return The snapshot of the Metrics, with the queue depth and the dropped requests
+		"""
+		labels = (('plugin', self.name),)
+		gauges = [(('tmc_queue_depth', labels), sum(len(queue) for queue in self.queues))]
+		for name, (waiting, dropped) in self.getQueueStats().items():
+			gauges.append((('tmc_queue_dropped', labels + (('method', str(name)),)), dropped))
+		return self.metrics.snapshot(gauges)
+
+	def getQueueStats(self):
+		"""
+		\brief Get the state of the queue policies
+		\return A dict of (waiting, dropped) by the name the policy applies to
+		"""
+		return dict((name, (policy.waiting, policy.dropped)) 
+					for name, policy in self.__queuePolicies.items())
+
+	def setCallTimeout(self, timeout):
+		"""
+		\brief Set the default timeout of the function calls of this plugin
+		\param timeout The seconds to wait for a result before Timeout is raised, None to wait forever
+
+		A single call may override it with callFunction(name, *args, timeout = seconds).
+		"""
+		self.callTimeout = timeout
+
+	def __reject(self, job, error):
+		"""
+		\brief Answer a function call that is not processed
+		\param job The request
+		\param error The Error to answer with
+		"""
+		if isinstance(job, Method):
+			return
+		if isinstance(job, LocalFunction):
+			job.future.setAnswer(LocalResult(error, True))
+			return
+		if isinstance(job, Batch):
+			self.__answerBatch(job, error, True)
+			return
+		self.__answerLock.acquire()
+		try:
+			sendMessage(self.inPipe, Result(job, error, True))
+		finally:
+			self.__answerLock.release()
+
+	def __answerBatch(self, job, value, error = False):
+		"""
+		\brief Send the result of a share of a Batch to the PluginManager, which collects the shares
+		\param job The Batch
+		\param value The list of (error, value) of the calls or the Error of the whole share
+		\param error Is the value an Error?
+		"""
+		result = Result(job, value, error)
+		#the questioner of the share only names the caller of the batch
+		result.questioner = None
+		self.__answerLock.acquire()
+		try:
+			sendMessage(self.inPipe, result)
+		finally:
+			self.__answerLock.release()
 			
 	def shutDown(self):
 		pass
 
 	def __stop(self):
 		self.__running = False
-		self.outPipe.send(Stop())
+		self.__outPipeSend(Stop())
 		self.shutDown()
 	
 	def __outPipeSend(self, content):
-		self.outPipe.send(content)
+		self.__sendLock.acquire()
+		try:
+			sendMessage(self.outPipe, content)
+		finally:
+			self.__sendLock.release()
+
+	def __send(self, message):
+		"""
+		\brief Send a request of this plugin to the PluginManager
+		\param message The request
+		"""
+		message.questioner = self.name
+		message.priority = self.__priority()
+		self.__trace(message)
+		self.__outPipeSend(message)
+
+	def __priority(self):
+		"""
+		\brief Get the priority for the requests of the current thread
+		\return The priority of the job the worker processes, Priority.NORMAL outside of jobs
+		"""
+		return getattr(self.__local, 'priority', Priority.NORMAL)
+
+	def __trace(self, message):
+		"""
+		\brief Give a request of this plugin its span in the trace of the current job
+		\param message The request
+
+		Outside of jobs the request starts a new trace.
+		"""
+		message.spanId = newSpanId()
+		traceId = getattr(self.__local, 'traceId', None)
+		if traceId == None:
+			message.traceId = message.spanId
+			return
+		message.traceId = traceId
+		if self.__tracer != None:
+			self.__tracer.flow(thread.get_ident(), time.time(), message.spanId)
+
+	def __groupMember(self, name):
+		"""
+		\brief Get the plugin of this group that is the target of the call
+		\param name The (plugin, name) tuple of the call
+		\return The plugin instance or None if the target does not run in this process
+		"""
+		if self.__group != None:
+			return self.__group.members.get(name[0])
+		return None
 
 	def signalEvent(self, eventName, *args):
-		self.__outPipeSend(Event(eventName, args))
+		"""
+		\brief Signal an event to its listeners
+		\param eventName The name of the event
+		\param args The arguments to the callbacks of the listeners
+
+		An event nobody listens to is not sent to the PluginManager at all.
+		"""
+		if not self.hasListeners(eventName):
+			self.metrics.count('tmc_events_skipped_total', (('plugin', self.name), ('event', eventName)))
+			return
+		self.__send(Event(eventName, args))
+
+	def hasListeners(self, eventName):
+		"""
+		\brief Does any plugin listen to an event of this plugin?
+		\param eventName The name of the event
+		\return False if the PluginManager reported no listeners, True until it reported the listeners
+
+		The PluginManager pushes the listened events whenever they change,
+		so a provider can skip the work of producing an event nobody wants.
+		"""
+		listened = self.__listenedEvents
+		return listened == None or eventName in listened
 
 	def callMethod(self, name, *args):
-		self.__outPipeSend(Method(name, args))
+		member = self.__groupMember(name)
+		if member != None:
+			method = LocalMethod(name[1], copyValue(args), self.name, self.__priority())
+			self.__trace(method)
+			member._enqueue(method)
+		else:
+			self.__send(Method(name, args))
+
+	def callFunction(self, name, *args, **options):
+		"""
+		\brief Call a function of another plugin and wait for its result
+		\param name The (plugin, function) tuple to call
+		\param args The arguments to the function
+		\param options timeout = the seconds to wait for the result instead of callTimeout
+		\return The value the function returned
+
+		Any number of threads may have calls in flight at the same time,
+		the answers are matched to their calls by id.
+		Raises Timeout if the result did not arrive in time.
+		"""
+		return self.callFunctionAsync(name, *args, **options).result()
+
+	def callFunctionAsync(self, name, *args, **options):
+		"""
+		\brief Call a function of another plugin without waiting for its result
+		\param name The (plugin, function) tuple to call
+		\param args The arguments to the function
+		\param options timeout = the seconds to wait for the result instead of callTimeout
+		\return The Future that receives the result
+
+		Use gather to wait for several of these calls together.
+		Calls to plugins of the same PluginGroup are put directly into their queue,
+		their arguments and results are copied instead of being sent through the pipes.
+		The deadline of the call is sent along, a call made while processing a call with a deadline
+		gets the earlier of both, so the callee skips work whose caller has given up already.
+		"""
+		deadline = self.__deadline(options)
+		member = self.__groupMember(name)
+		if member != None:
+			function = LocalFunction(name[1], copyValue(args), self.name, self.__priority())
+			function.deadline = deadline or 0
+			function.future = Future(deadline, lambda: self.__abandon(name, None), self.__nestedWaiter())
+			self.__trace(function)
+			member._enqueue(function)
+			return function.future
+		function = Function(name, args)
+		key = (name, function.args)
+		if name in self.__cache.functions:
+			cached = self.__cache.get(key)
+			if cached != None:
+				self.metrics.count('tmc_cache_hits_total', (('plugin', self.name), ('target', str(name[0])), 
+															('function', name[1])))
+				future = Future()
+				future.setAnswer(cached)
+				return future
+		return self.__dispatch(function, deadline, (key, self.__cache.generation))
+
+	def callMany(self, calls, **options):
+		"""
+		\brief Call several functions of other plugins in one exchange and wait for all results
+		\param calls The list of ((plugin, function), args) with args the tuple of arguments
+		\param options timeout = the seconds to wait for the results instead of callTimeout
+		\return The list of the values the functions returned, in the order of the calls
+
+		The calls are sent in a single envelope, the PluginManager splits it by plugin
+		and each plugin processes its share as one job, in the order of the calls.
+		The shares of different plugins are processed at the same time.
+		If calls failed, the Error of the first is raised after all calls were made.
+		"""
+		deadline = self.__deadline(options)
+		if len(calls) == 0:
+			return []
+		batch = Batch((None, 'callMany'), [(name, cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)) 
+											for name, args in calls])
+		results = self.__dispatch(batch, deadline).result()
+		for error, value in results:
+			if error:
+				raise value
+		return [value for error, value in results]
+
+	def __deadline(self, options):
+		"""
+		\brief Get the deadline of a call
+		\param options The options of the call
+		\return The time.time() after which the caller gives up or None
+		"""
+		timeout = options.pop('timeout', self.callTimeout)
+		if len(options) > 0:
+			raise TypeError('Unknown call options ' + ', '.join(options))
+		deadline = getattr(self.__local, 'deadline', None)
+		if timeout != None and (deadline == None or time.time() + timeout < deadline):
+			deadline = time.time() + timeout
+		return deadline
+
+	def __dispatch(self, function, deadline, cacheKey = None):
+		"""
+		\brief Send a call to the PluginManager
+		\param function The Function or Batch
+		\param deadline The time.time() after which the caller gives up or None
+		\param cacheKey The (key, cache generation) of a call whose result may be cached
+		\return The Future that receives the result
+		"""
+		function.id = next(self.__callIds)
+		function.deadline = deadline or 0
+		future = Future(deadline, lambda: self.__abandon(function.name, function.id), self.__nestedWaiter())
+		future.cacheKey = cacheKey
+		self.__pendingLock.acquire()
+		self.__pending[function.id] = future
+		self.__pendingLock.release()
+		self.__send(function)
+		return future
+
+	def publishState(self, key, value):
+		"""
+		\brief Set a value of the state this plugin shares with the plugins that replicate it
+		\param key The key of the value, e.g. currentMap
+		\param value The picklable value, it replaces the previous one in all copies
+		"""
+		self.callMethod((None, 'publishState'), key, value)
 
-	def callFunction(self, name, *args):
-		#Clear any previous answers if there are some
-		while self.outPipe.poll():
-			self.outPipe.recv()
+	def updateState(self, key, changes, removed = ()):
+		"""
+		\brief Change some entries of a dict in the shared state of this plugin
+		\param key The key of the dict
+		\param changes The dict of the entries to add or replace
+		\param removed The keys of the entries to remove
 
-		self.__outPipeSend(Function(name, args))
+		Only the changes are sent to the copies, e.g. the player who connected instead of all players.
+		"""
+		self.callMethod((None, 'updateState'), key, changes, list(removed))
+
+	def subscribeState(self, plugin, callback = None):
+		"""
+		\brief Keep a local copy of the state another plugin publishes
+		\param plugin The name of the publishing plugin
+		\param callback The name of the method of this plugin to call with (plugin, key) after a value changed
+		\return Whether the state arrived within callTimeout
 
-		result = self.outPipe.recv()
-		return result.getValue()
+		Afterwards getState reads the values without asking anyone.
+		Like an event subscription, the copy is kept by the PluginManager when this plugin is restarted
+		from a snapshot.
+		"""
+		synced = self.__replica.subscribed(plugin)
+		self.callMethod((None, 'subscribeState'), plugin, callback)
+		self.hasWork.acquire()
+		self.__syncWaits += 1
+		self.__wakeBlocked()
+		self.hasWork.release()
+		try:
+			return synced.wait(self.callTimeout)
+		finally:
+			self.hasWork.acquire()
+			self.__syncWaits -= 1
+			self.hasWork.release()
+
+	def getState(self, plugin, key, default = None):
+		"""
+		\brief Read a value of the local copy of the state of another plugin
+		\param plugin The name of the publishing plugin, it must be subscribed with subscribeState
+		\param key The key of the value
+		\param default The value to return if the plugin did not publish the key
+		\return The value, which must not be modified
+		"""
+		return self.__replica.get(plugin, key, default)
+
+	def __nestedWaiter(self):
+		"""
+		\brief Get the function that waits for a result of a call made by the current job
+		\return The wait function for the Future or None outside of jobs
+
+		While a worker waits, it processes the requests of the same trace, which are the calls
+		back into this plugin that the result depends on.
+		Without this a plugin with one worker could never answer a call
+		whose callee calls back, e.g. Maps -> Karma -> Maps.
+		"""
+		traceId = getattr(self.__local, 'traceId', None)
+		if traceId == None:
+			return None
+		return lambda future, timeout: self.__waitNested(future, timeout, traceId)
+
+	def __waitNested(self, future, timeout, traceId):
+		"""
+		\brief Wait for the result of a call and process the nested requests meanwhile
+		\param future The Future of the call
+		\param timeout The seconds to wait, None to wait forever
+		\param traceId The trace of the waiting job
+		\return Did the answer arrive?
+		"""
+		end = timeout != None and time.time() + timeout or None
+		self.hasWork.acquire()
+		try:
+			future.onAnswer = self.__wakeNested
+			self.__waitingTraces[traceId] = self.__waitingTraces.get(traceId, 0) + 1
+			self.__wakeBlocked()
+			while not future.done():
+				job, key, own = self.__takeNested(traceId)
+				if job != None:
+					self.hasWork.release()
+					try:
+						self.__runNested(job, key, own)
+					finally:
+						self.hasWork.acquire()
+					continue
+				if end != None and time.time() >= end:
+					return False
+				self.__nestedWork.wait(end != None and max(0.001, end - time.time()) or None)
+			return True
+		finally:
+			self.__waitingTraces[traceId] -= 1
+			if self.__waitingTraces[traceId] == 0:
+				del self.__waitingTraces[traceId]
+			self.hasWork.release()
+
+	def __wakeNested(self):
+		"""
+		\brief Wake the workers waiting for nested calls, an answer has arrived
+		"""
+		self.hasWork.acquire()
+		self.__nestedWork.notify_all()
+		self.hasWork.release()
+
+	def __takeNested(self, traceId):
+		"""
+		\brief Take the first waiting request of the trace
+		\param traceId The trace of the waiting job
+		\return The job, its ordering key and whether the key is held by this thread already, 
+			the job is None if there is none
+
+		Called with the lock of the queue held.
+		The ordering keys the waiting thread holds itself do not block the nested request.
+		"""
+		keys = getattr(self.__local, 'keys', [])
+		for queue in self.queues:
+			for job in queue:
+				if getattr(job, 'traceId', 0) != traceId or isinstance(job, Stop):
+					continue
+				key = job.orderingKey
+				own = key == None or key in keys
+				if own or not key in self.__busyKeys:
+					queue.remove(job)
+					if not own:
+						self.__busyKeys.add(key)
+					if job.queuePolicy != None:
+						job.queuePolicy.taken(job)
+					return job, key, own
+		return None, None, True
+
+	def __runNested(self, job, key, own):
+		"""
+		\brief Process a nested request on the waiting thread
+		\param job The request
+		\param key The ordering key of the request
+		\param own Does the thread hold the key already?
+		"""
+		local = self.__local
+		saved = [getattr(local, attribute, None) 
+				for attribute in ('questioner', 'priority', 'traceId', 'deadline', 'callerWaits')]
+		if not own:
+			local.keys = getattr(local, 'keys', []) + [key]
+		try:
+			self.__runJob(job)
+		except Exception:
+			#the waiting job must go on
+			traceback.print_exc()
+		finally:
+			local.questioner, local.priority, local.traceId, local.deadline, local.callerWaits = saved
+			if not own:
+				local.keys.remove(key)
+				self.__releaseKey(key)
+
+	def __abandon(self, name, id):
+		"""
+		\brief Give up waiting for the result of a call
+		\param name The (plugin, function) tuple of the call
+		\param id The id of the call, None for a call within the PluginGroup
+		\return The Timeout to raise in the caller
+		"""
+		if id != None:
+			self.__pendingLock.acquire()
+			if id in self.__pending:
+				#the late answer is dropped silently
+				self.__pending[id] = None
+			self.__pendingLock.release()
+		self.metrics.count('tmc_call_timeouts_total', (('plugin', self.name), ('target', str(name[0])), 
+													('function', name[1])))
+		return Timeout('Call ' + str(name[0]) + '.' + name[1] + ' from ' + self.name + ' timed out')
+
+	def __receiveAnswers(self):
+		"""
+		\brief Receive the answers to function calls and hand them to the waiting callers
+		"""
+		#the jobs that are finished after the Stop still get their answers
+		while True:
+			try:
+				answer = receiveMessage(self.outPipe)
+			except (EOFError, IOError):
+				break
+			self._receiveAnswer(answer)
+
+	def _receiveAnswer(self, answer):
+		"""
+		\brief Hand the answer to the caller that waits for it
+		\param answer The Result
+		"""
+		self.__pendingLock.acquire()
+		abandoned = self.__pending.get(answer.id, False) == None
+		future = self.__pending.pop(answer.id, None)
+		self.__pendingLock.release()
+		if future != None:
+			if answer.cacheEvents != None and future.cacheKey != None:
+				self.__cacheResult(future.cacheKey, answer)
+			future.setAnswer(answer)
+		elif not abandoned:
+			print('Dropped answer to unknown call ' + str(answer.id) 
+				+ ' in ' + self.__class__.__name__)
 	
+	def __cacheResult(self, cacheKey, answer):
+		"""
+		\brief Keep the result of a cacheable function
+		\param cacheKey The (key, cache generation) of the call
+		\param answer The Result
+		"""
+		key, generation = cacheKey
+		for plugin, event in self.__cache.put(key, answer, generation, answer.cacheEvents):
+			self.callMethod((None, 'subscribeEvent'), plugin, event, self.__cache.callback(plugin, event))
+
 	def log(self, *args):
 		string = ''
 		for i in args:
@@ -82,7 +762,16 @@ class PluginInterface(object):
 		self.callMethod(('Logger', 'log'), self.__class__.__name__ + ': ' + string)
 
 	def questioner(self):
-		return self.__questioner
+		return getattr(self.__local, 'questioner', None)
+
+	def callerWaits(self):
+		"""
+		\brief Does the caller of the current job wait for its result?
+		\return True for function calls, False for methods and outside of jobs
+
+		A method may hand its work on and return before it is done, nobody waits for it.
+		"""
+		return getattr(self.__local, 'callerWaits', False)
 
 	def _getTarget(self, name):
 		"""
@@ -91,90 +780,866 @@ class PluginInterface(object):
 		"""
 		return getattr(self, name)
 
+	def __takeJob(self):
+		"""
+		\brief Wait for the next job that may be processed now
+		\return The job and its ordering key or (None, None) if the plugin stops
+
+		The first job of the most urgent priority is taken, whose ordering key is not busy.
+		The Stop is taken last, when no other job waits.
+		"""
+		self.hasWork.acquire()
+		try:
+			while self.__running:
+				for queue in self.queues:
+					for job in queue:
+						if isinstance(job, Stop) and sum(len(waiting) for waiting in self.queues) > 1:
+							continue
+						key = job.orderingKey
+						if key == None or not key in self.__busyKeys:
+							queue.remove(job)
+							if key != None:
+								self.__busyKeys.add(key)
+							if job.queuePolicy != None:
+								job.queuePolicy.taken(job)
+							return job, key
+				self.hasWork.wait()
+			return None, None
+		finally:
+			self.hasWork.release()
+
+	def __releaseKey(self, key):
+		"""
+		\brief Allow the next job with this ordering key to be processed
+		"""
+		if key != None:
+			self.hasWork.acquire()
+			self.__busyKeys.discard(key)
+			self.hasWork.notify_all()
+			self.hasWork.release()
+
 	def __work(self):
 		while self.__running:
 			try:
-				self.hasWork.acquire()
-				while len(self.queue) < 1:
-					self.hasWork.wait()
-				job = self.queue[0]
-				del self.queue[0]
-				self.hasWork.release()
-				
-				if isinstance(job, Stop):
-					self.__running = False
-				elif isinstance(job, Method):
-					try:
-						method = self._getTarget(job.name)
-					except AttributeError:
-						print('Unknown method ' + self.__class__.__name__ + '.'
-							 + job.name + str(job.getArgs()))
-					self.__questioner = str(job.questioner)
-					try:
-						method(*job.getArgs())
-					except TypeError:
-						print('Used wrong arguments in method call ' 
-							+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs()) 
-							+ ' from ' + str(job.questioner))
-						raise
-					except:
-						print('Exception in method call ' 
-							+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs()) 
-							+ ' from ' + str(job.questioner))
-						raise
-				elif isinstance(job, Event):
-					pass
-				elif isinstance(job, Function):
-					try:
-						function = self._getTarget(job.name)
-					except AttributeError:
-						print('Unknown function ' + self.__class__.__name__ + '.'
-							+ str(job.name) + str(job.getArgs()))
-					self.__questioner = job.questioner
-					try:
-						value = function(*job.getArgs())
-					except TypeError:
-						print('Used wrong arguments in function call ' 
-							+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs())
-							+ ' from ' + job.questioner)
-						raise
-					except:
-						print('Exception in function call ' 
-							+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs()) 
-							+ ' from ' + job.questioner)
-						raise
-					self.inPipe.send(Result(job, value))
+				job, key = self.__takeJob()
+				self.__local.keys = [key]
+				try:
+					self.__runJob(job)
+				finally:
+					self.__releaseKey(key)
 			except KeyboardInterrupt:
 				self.__stop()
-				
+			except Exception:
+				#the worker must go on with the next job
+				traceback.print_exc()
+
+	def __runJob(self, job):
+		"""
+		\brief Process one job from the queue
+		\param job The job to process
+		"""
+		if job == None:
+			pass
+		elif isinstance(job, Stop):
+			self.hasWork.acquire()
+			self.__running = False
+			self.hasWork.notify_all()
+			self.hasWork.release()
+		elif isinstance(job, Event):
+			pass
+		elif isinstance(job, Method):
+			try:
+				method = self._getTarget(job.name)
+			except AttributeError:
+				print('Unknown method ' + self.__class__.__name__ + '.'
+					 + job.name + str(job.getArgs()))
+				return
+			self.__local.questioner = str(job.questioner)
+			self.__local.priority = job.priority
+			self.__local.traceId = job.traceId or newSpanId()
+			self.__local.deadline = None
+			self.__local.callerWaits = False
+			start = time.time()
+			try:
+				method(*job.getArgs())
+			except TypeError:
+				print('Used wrong arguments in method call ' 
+					+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs()) 
+					+ ' from ' + str(job.questioner))
+				traceback.print_exc()
+			except Exception:
+				print('Exception in method call ' 
+					+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs()) 
+					+ ' from ' + str(job.questioner))
+				traceback.print_exc()
+			finally:
+				self.__record(job, start)
+		elif isinstance(job, Batch):
+			if job.deadline and time.time() > job.deadline:
+				self.metrics.count('tmc_deadline_expired_total', (('plugin', self.name), ('function', job.name)))
+				self.__reject(job, Timeout('Calls to ' + self.name + ' expired in the queue'))
+				return
+			self.__local.questioner = job.questioner
+			self.__local.priority = job.priority
+			self.__local.traceId = job.traceId or newSpanId()
+			self.__local.deadline = job.deadline or None
+			self.__local.callerWaits = True
+			start = time.time()
+			results = []
+			try:
+				for name, args in job.getArgs():
+					callStart = time.time()
+					try:
+						results.append((False, self._getTarget(name[1])(*cPickle.loads(args))))
+					except Exception as e:
+						print('Exception in batched call ' + self.name + '.' + str(name[1]) 
+							+ ' from ' + str(job.questioner) + ': ' + repr(e))
+						results.append((True, Error(self.name + '.' + str(name[1]) + ': ' + repr(e))))
+					self.metrics.observe('tmc_handler_seconds', (('plugin', self.name), ('method', name[1])), 
+										time.time() - callStart)
+			finally:
+				self.__record(job, start)
+			self.__answerBatch(job, results)
+		elif isinstance(job, Function):
+			if job.deadline and time.time() > job.deadline:
+				#the caller has given up already
+				self.metrics.count('tmc_deadline_expired_total', (('plugin', self.name), ('function', job.name)))
+				self.__reject(job, Timeout('Call ' + self.name + '.' + str(job.name) + ' expired in the queue'))
+				return
+			try:
+				function = self._getTarget(job.name)
+			except AttributeError:
+				print('Unknown function ' + self.__class__.__name__ + '.'
+					+ str(job.name) + str(job.getArgs()))
+				self.__reject(job, Error('Unknown function ' + self.name + '.' + str(job.name)))
+				return
+			self.__local.questioner = job.questioner
+			self.__local.priority = job.priority
+			self.__local.traceId = job.traceId or newSpanId()
+			self.__local.deadline = job.deadline or None
+			self.__local.callerWaits = True
+			start = time.time()
+			try:
+				value = function(*job.getArgs())
+			except Exception as e:
+				if isinstance(e, TypeError):
+					print('Used wrong arguments in function call ' 
+						+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs())
+						+ ' from ' + str(job.questioner))
+				else:
+					print('Exception in function call ' 
+						+ self.__class__.__name__ + '.' + str(job.name) + str(job.getArgs()) 
+						+ ' from ' + str(job.questioner))
+				traceback.print_exc()
+				#the caller gets the error instead of waiting for an answer that never comes
+				self.__reject(job, Error(self.name + '.' + str(job.name) + ': ' + repr(e)))
+				return
+			finally:
+				self.__record(job, start)
+			if isinstance(job, LocalFunction):
+				try:
+					job.future.setAnswer(LocalResult(copyValue(value)))
+				except Exception as e:
+					self.__reject(job, Error(self.name + '.' + str(job.name) + ': ' + repr(e)))
+				return
+			self.__answerLock.acquire()
+			try:
+				sendMessage(self.inPipe, Result(job, value, False, getattr(function, 'cacheEvents', None)))
+			finally:
+				self.__answerLock.release()
+
+	def __record(self, job, start):
+		"""
+		\brief Record the metrics and the span of a processed job
+		\param job The Method or Function
+		\param start The time.time() the processing started
+		"""
+		duration = time.time() - start
+		self.metrics.observe('tmc_handler_seconds', (('plugin', self.name), ('method', job.name)), duration)
+		if self.__tracer != None:
+			self.__tracer.span(self.name + '.' + str(job.name), thread.get_ident(), start, duration, 
+							self.__local.traceId, job.spanId, 
+							{'from' : str(job.questioner), 'queued_ms' : round((start - job.received) * 1e3, 3)})
+
+_header = struct.Struct('<BBBQQdHHHI') #kind, flags, priority, trace id, span id, deadline, lengths of target, name and questioner, id
+_stamp = struct.Struct('<BQQ') #priority, trace id and span id within the header
+_messageKinds = {} #The message classes by their kind
+
+def sendMessage(connection, message):
+	"""
+	\brief Send a message over a pipe as one envelope
+	\param connection The connection to send on
+	\param message The message to send
+	"""
+	connection.send_bytes(message.encode())
 
-				
+def receiveMessage(connection):
+	"""
+	\brief Receive the next message from a pipe
+	\param connection The connection to receive from
+	\return The decoded message
+	"""
+	return decodeMessage(connection.recv_bytes())
+
+def encodeMessage(kind, flags, priority, traceId, spanId, deadline, target, name, questioner, id, payload):
+	"""
+	\brief Pack the fields of a message into an envelope
+	\return The envelope as string
+
+	The envelope is a fixed header followed by the target, name and questioner
+	strings and the already pickled payload, which is never touched again until
+	the recipient needs it.
+	"""
+	return (_header.pack(kind, flags, priority, traceId, spanId, deadline, 
+						len(target), len(name), len(questioner), id)
+			+ target + name + questioner + payload)
+
+def stampHeader(header, priority, traceId, spanId):
+	"""
+	\brief Replace the priority and the trace of an encoded header
+	\param header The envelope header from encodeMessage
+	\return The new header
+	"""
+	return header[:2] + _stamp.pack(priority, traceId, spanId) + header[2 + _stamp.size:]
+
+def decodeMessage(data):
+	"""
+	\brief Unpack an envelope into a message
+	\param data The envelope
+	\return The message, its payload is still pickled
+	"""
+	(kind, flags, priority, traceId, spanId, deadline,
+		targetLength, nameLength, questionerLength, id) = _header.unpack_from(data)
+	offset = _header.size
+	target = data[offset:offset + targetLength]
+	offset += targetLength
+	name = data[offset:offset + nameLength]
+	offset += nameLength
+	questioner = data[offset:offset + questionerLength]
+	offset += questionerLength
+	message = _messageKinds[kind].fromEnvelope(flags, target, name, questioner, id, data[offset:])
+	message.priority = priority
+	message.traceId = traceId
+	message.spanId = spanId
+	message.deadline = deadline
+	return message
+
+class Priority(object):
+	"""
+	\brief The priority classes of the messages, the lower the more urgent
+	"""
+	INTERACTIVE = 0 #A player waits for it, e.g. a click on a manialink or a chat command
+	NORMAL = 1
+	BULK = 2 #Nobody waits for it, e.g. logging or the database updates at the end of a map
+	LEVELS = 3 #The number of priority classes
+
+class Function(object):
+	kind = 1
+	TARGETED = 1 #Flag: the name is a (plugin, name) tuple
 
-class Function:
 	def __init__(self, name, args, questioner = None):
 		self.name = name
-		self.args = cPickle.dumps(args)
+		self.args = cPickle.dumps(args, cPickle.HIGHEST_PROTOCOL)
 		self.questioner = questioner
+		self.id = None #The id that correlates the call with its result
+		self.priority = Priority.NORMAL
+		self.traceId = 0 #The trace the call belongs to, 0 if it has none
+		self.spanId = 0 #The span of the call in the trace
+		self.deadline = 0 #The time.time() after which the caller does not wait anymore, 0 for none
 
 	def getArgs(self):
 		return cPickle.loads(self.args)
 
+	def encode(self):
+		if isinstance(self.name, tuple):
+			flags = Function.TARGETED
+			target = self.name[0] or ''
+			name = self.name[1]
+		else:
+			flags = 0
+			target = ''
+			name = self.name
+		return encodeMessage(self.kind, flags, self.priority, self.traceId, self.spanId, self.deadline, target, name, 
+							self.questioner or '', self.id or 0, self.args)
+
+	@classmethod
+	def fromEnvelope(cls, flags, target, name, questioner, id, payload):
+		function = cls.__new__(cls)
+		if flags & Function.TARGETED:
+			function.name = (target or None, name)
+		else:
+			function.name = name
+		function.args = payload
+		function.questioner = questioner or None
+		function.id = id or None
+		return function
+
 class Method(Function):
-	pass
+	kind = 2
 
 class Event(Function):
-	pass
+	kind = 3
+
+class Batch(Function):
+	"""
+	\brief Several function calls in one envelope
+	
+	The args are the list of ((plugin, function), pickled args) of the calls, 
+	the result is the list of (error, value) of the calls.
+	"""
+	kind = 6
 
-class Result:
-	def __init__(self, function, result):
-		self.function = function
-		self.value = cPickle.dumps(result)
+class Result(object):
+	kind = 4
+	ERROR = 1 #Flag: the value is an exception
+	CACHEABLE = 2 #Flag: the value may be cached, the name lists the events that invalidate it
+
+	def __init__(self, function, result, error = False, cacheEvents = None):
+		self.id = function.id
+		self.questioner = function.questioner
+		self.value = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+		self.error = error #Is the value an exception to raise in the caller?
+		self.cacheEvents = cacheEvents #The (plugin, event) tuples that invalidate the cached value, None if not cacheable
 
 	def getValue(self):
-		return cPickle.loads(self.value)
+		value = cPickle.loads(self.value)
+		if self.error:
+			raise value
+		return value
 
-class Stop:
-	pass
+	def encode(self):
+		flags = self.error and Result.ERROR or 0
+		events = ''
+		if self.cacheEvents != None:
+			flags |= Result.CACHEABLE
+			events = ','.join(plugin + '.' + event for plugin, event in self.cacheEvents)
+		return encodeMessage(self.kind, flags, Priority.INTERACTIVE, 0, 0, 0, '', events, 
+							self.questioner or '', self.id or 0, self.value)
+
+	@classmethod
+	def fromEnvelope(cls, flags, target, name, questioner, id, payload):
+		result = cls.__new__(cls)
+		result.id = id or None
+		result.questioner = questioner or None
+		result.value = payload
+		result.error = bool(flags & Result.ERROR)
+		result.cacheEvents = None
+		if flags & Result.CACHEABLE:
+			result.cacheEvents = tuple(tuple(event.split('.', 1)) for event in name.split(',') if event)
+		return result
+
+class LocalMethod(Method):
+	"""
+	\brief A method call between plugins of the same PluginGroup, its args are a copy that is not sent
+	"""
+	def __init__(self, name, args, questioner, priority):
+		self.name = name
+		self.args = args
+		self.questioner = questioner
+		self.id = None
+		self.priority = priority
+		self.traceId = 0
+		self.spanId = 0
+		self.deadline = 0
+
+	def getArgs(self):
+		return self.args
+
+class LocalFunction(Function):
+	"""
+	\brief A function call between plugins of the same PluginGroup, its args are a copy that is not sent
+	"""
+	def __init__(self, name, args, questioner, priority):
+		self.name = name
+		self.args = args
+		self.questioner = questioner
+		self.id = None
+		self.priority = priority
+		self.traceId = 0
+		self.spanId = 0
+		self.deadline = 0
+		self.future = Future() #Receives the result
+
+	def getArgs(self):
+		return self.args
+
+class LocalResult(object):
+	"""
+	\brief The result of a LocalFunction, its value is a copy that is not sent
+	"""
+	def __init__(self, value, error = False):
+		self.value = value
+		self.error = error #Is the value an exception to raise in the caller?
+
+	def getValue(self):
+		if self.error:
+			raise self.value
+		return self.value
+
+def copyValue(value):
+	"""
+	\brief Copy a value passed between the plugins of a PluginGroup
+	\param value The arguments or the result of a call
+	\return The copy, as the callee or caller would get it through the pipes
+	"""
+	return cPickle.loads(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+class Future(object):
+	"""
+	\brief The answer to a function call that may not have arrived yet
+	"""
+	def __init__(self, deadline = None, abandon = None, wait = None):
+		"""
+		\param deadline The time.time() after which result gives up, None to wait forever
+		\param abandon Called when result gives up, returns the Timeout to raise
+		\param wait Called with the Future and the timeout to wait for the answer instead of blocking,
+			returns whether the answer arrived
+		"""
+		self.__done = threading.Event()
+		self.__answer = None
+		self.deadline = deadline
+		self.__abandon = abandon
+		self.__wait = wait
+		self.__timeout = None #The Timeout once result gave up
+		self.onAnswer = None #Called when the answer arrived
+		self.cacheKey = None #The (key, cache generation) of a call whose result may be cached
+
+	def setAnswer(self, answer):
+		"""
+		\brief Store the answer and wake up the waiting threads
+		\param answer The Result of the call
+		"""
+		self.__answer = answer
+		self.__done.set()
+		if self.onAnswer != None:
+			self.onAnswer()
+
+	def done(self):
+		"""
+		\brief Has the answer arrived?
+		"""
+		return self.__done.is_set()
+
+	def result(self):
+		"""
+		\brief Wait for the answer
+		\return The value of the answer
+
+		Raises Timeout if the answer did not arrive before the deadline.
+		"""
+		if self.__timeout == None:
+			timeout = None
+			if self.deadline != None:
+				timeout = max(0, self.deadline - time.time())
+			if self.__wait != None:
+				answered = self.__wait(self, timeout)
+			else:
+				answered = self.__done.wait(timeout)
+			if answered:
+				return self.__answer.getValue()
+			self.__timeout = self.__abandon != None and self.__abandon() or Timeout('The call timed out')
+		raise self.__timeout
+
+def cacheable(*events):
+	"""
+	\brief Mark a function of a plugin as cacheable by its callers
+	\param events The (plugin, event) tuples that invalidate the results, 
+		e.g. ('TmConnector', 'MapListModified')
+
+	The callers keep the results by arguments and answer repeated calls without asking the plugin
+	until one of the events is signalled.
+	Use it for lookups whose results rarely change.
+	"""
+	def mark(function):
+		function.cacheEvents = events
+		return function
+	return mark
+
+class CallCache(object):
+	"""
+	\brief The results of the cacheable functions a plugin called, the least recently used are dropped first
+	"""
+	CALLBACK = 'invalidateCache:' #The prefix of the names of the event callbacks that invalidate results
+
+	def __init__(self, size):
+		self.size = size #The number of results to keep
+		self.functions = set() #The (plugin, function) names known to be cacheable
+		self.callbacks = {} #The (plugin, event) by the name of the event callback that invalidates it
+		self.generation = 0 #Increases with every invalidation
+		self.__results = collections.OrderedDict() #The Result of each (name, pickled args), oldest first
+		self.__byFunction = {} #The keys of the results of each function
+		self.__invalidates = {} #The functions whose results each (plugin, event) invalidates
+		self.__lock = threading.Lock()
+
+	def callback(self, plugin, event):
+		"""
+		\brief Get the name of the event callback that invalidates the results depending on the event
+		"""
+		return CallCache.CALLBACK + plugin + '.' + event
+
+	def get(self, key):
+		"""
+		\brief Get a cached result
+		\param key The (name, pickled args) of the call
+		\return The Result or None if there is none
+		"""
+		self.__lock.acquire()
+		try:
+			result = self.__results.pop(key, None)
+			if result != None:
+				self.__results[key] = result
+			return result
+		finally:
+			self.__lock.release()
+
+	def put(self, key, result, generation, events):
+		"""
+		\brief Keep the result of a call
+		\param key The (name, pickled args) of the call
+		\param result The Result
+		\param generation The generation when the call was made, 
+			the result is dropped if anything was invalidated since
+		\param events The (plugin, event) tuples that invalidate the result
+		\return The events that are new and have to be subscribed to
+		
+		The result is not kept if it depends on new events, 
+		it could be outdated before the subscription is in place.
+		"""
+		self.__lock.acquire()
+		try:
+			name = key[0]
+			self.functions.add(name)
+			new = []
+			for event in events:
+				if not event in self.__invalidates:
+					self.__invalidates[event] = set()
+					self.callbacks[self.callback(*event)] = event
+					new.append(event)
+				self.__invalidates[event].add(name)
+			if len(new) > 0 or generation != self.generation:
+				return new
+			self.__results[key] = result
+			self.__byFunction.setdefault(name, set()).add(key)
+			while len(self.__results) > self.size:
+				oldKey, oldResult = self.__results.popitem(False)
+				self.__byFunction[oldKey[0]].discard(oldKey)
+			return new
+		finally:
+			self.__lock.release()
+
+	def invalidate(self, event):
+		"""
+		\brief Drop the results that depend on the event
+		\param event The (plugin, event) tuple
+		"""
+		self.__lock.acquire()
+		try:
+			self.generation += 1
+			for name in self.__invalidates.get(event, ()):
+				for key in self.__byFunction.pop(name, ()):
+					del self.__results[key]
+		finally:
+			self.__lock.release()
+
+class StateReplica(object):
+	"""
+	\brief The local read-only copies of the state other plugins publish
+
+	The PluginManager pushes the whole state of a plugin when it is subscribed and every change afterwards,
+	all with the same priority, so they arrive in the order they were made.
+	"""
+	UPDATE = 'replicateState:' #The prefix of the name of the pushes, followed by the callback of the subscriber
+
+	def __init__(self):
+		self.values = {} #The state of each replicated plugin, a dict by key, by plugin name
+		self.synced = {} #The threading.Event that is set once the whole state of a plugin arrived, by plugin name
+		self.__lock = threading.Lock()
+
+	def apply(self, plugin, action, key, value):
+		"""
+		\brief Apply a push of the PluginManager
+		\param plugin The name of the plugin whose state changed
+		\param action 'snapshot' for the whole state, 'set' for a new value or 'update' for changes to a dict
+		\param key The key of the changed value, None for a snapshot
+		\param value The whole state, the new value or the (changes, removed) of the dict
+		\return The keys that changed
+
+		A changed dict is replaced by an updated copy,
+		so a worker that reads the old one is not disturbed.
+		"""
+		self.__lock.acquire()
+		try:
+			if action == 'snapshot':
+				self.values[plugin] = value
+				self.synced.setdefault(plugin, threading.Event()).set()
+				return value.keys()
+			state = self.values.setdefault(plugin, {})
+			if action == 'set':
+				state[key] = value
+			else:
+				changes, removed = value
+				entries = dict(state.get(key, {}))
+				entries.update(changes)
+				for entry in removed:
+					entries.pop(entry, None)
+				state[key] = entries
+			return [key]
+		finally:
+			self.__lock.release()
+
+	def get(self, plugin, key, default):
+		"""
+		\brief Read a replicated value
+		\return The value or default if the plugin did not publish it
+		"""
+		return self.values.get(plugin, {}).get(key, default)
+
+	def subscribed(self, plugin):
+		"""
+		\brief Get the Event that is set once the whole state of the plugin arrived
+		"""
+		self.__lock.acquire()
+		try:
+			return self.synced.setdefault(plugin, threading.Event())
+		finally:
+			self.__lock.release()
+
+class QueuePolicy(object):
+	"""
+	\brief Bounds the requests of one name that wait in the queue of a plugin
+
+	All methods are called with the lock of the queue held.
+	"""
+	BLOCK = 0 #The producer waits until there is room
+	DROP_OLDEST = 1 #The oldest waiting request is dropped
+	COALESCE = 2 #A request replaces the waiting one with the same key, beyond the limit the oldest is dropped
+
+	def __init__(self, limit, policy, key, lock):
+		self.limit = limit #The number of requests that may wait
+		self.policy = policy #What happens to requests beyond the limit
+		self.key = key #Maps a request to its coalescing key
+		self.waiting = 0 #The number of waiting requests
+		self.dropped = 0 #The number of requests dropped or replaced so far
+		self.__queued = collections.deque() #The waiting requests, oldest first
+		self.__byKey = {} #The waiting request of each coalescing key
+		self.__room = threading.Condition(lock) #Wakes blocked producers when a request was taken
+
+	def admit(self, job, mayBlock):
+		"""
+		\brief Account for a new request, blocks the producer if there is no room
+		\param job The new request
+		\param mayBlock Returns whether the producer may still wait, otherwise the request goes beyond the limit
+		\return False if the request was merged into a waiting one and must not be queued
+		"""
+		if self.policy == QueuePolicy.COALESCE and isinstance(job, Method):
+			job.coalesceKey = self.key(job)
+			waiting = self.__byKey.get(job.coalesceKey)
+			if waiting != None:
+				waiting.args = job.args
+				self.dropped += 1
+				return False
+			self.__byKey[job.coalesceKey] = job
+		elif self.policy == QueuePolicy.BLOCK and self.limit != None:
+			while self.waiting >= self.limit and mayBlock():
+				self.__room.wait()
+		self.__queued.append(job)
+		self.waiting += 1
+		return True
+
+	def evict(self):
+		"""
+		\brief Drop the oldest requests that exceed the limit
+		\return The dropped requests, to be removed from the queue
+		"""
+		dropped = []
+		if self.policy == QueuePolicy.BLOCK:
+			return dropped
+		while self.limit != None and self.waiting > self.limit:
+			job = self.__queued[0]
+			self.__forget(job)
+			self.dropped += 1
+			dropped.append(job)
+		return dropped
+
+	def taken(self, job):
+		"""
+		\brief Account for a request that a worker took from the queue
+		\param job The request
+		"""
+		self.__forget(job)
+		if self.policy == QueuePolicy.BLOCK:
+			self.__room.notify()
+
+	def wake(self):
+		"""
+		\brief Wake the blocked producers to check again whether they may go on
+		"""
+		self.__room.notify_all()
+
+	def __forget(self, job):
+		self.__queued.remove(job)
+		self.waiting -= 1
+		key = getattr(job, 'coalesceKey', None)
+		if self.__byKey.get(key) is job:
+			del self.__byKey[key]
+
+def orderByArgument(index):
+	"""
+	\brief Create an ordering key that serializes the requests with the same argument
+	\param index The position of the argument, e.g. of the login
+	\return The ordering key function for the PluginInterface constructor
+	"""
+	def key(job):
+		if isinstance(job, Batch):
+			#its arguments are the calls
+			return None
+		args = job.getArgs()
+		if len(args) > index:
+			try:
+				hash(args[index])
+				return args[index]
+			except TypeError:
+				pass
+		return None
+	return key
+
+def orderByQuestioner(job):
+	"""
+	\brief An ordering key that processes the requests of each plugin in order
+	"""
+	return job.questioner
+
+def gather(*futures):
+	"""
+	\brief Wait for the results of several asynchronous calls
+	\param futures The Futures returned by callFunctionAsync
+	\return The list of the results in the order of the futures
+	"""
+	return [f.result() for f in futures]
+
+class Stop(object):
+	kind = 5
+	priority = Priority.BULK #Let the waiting work finish first
+
+	def encode(self):
+		return encodeMessage(self.kind, 0, self.priority, 0, 0, 0, '', '', '', 0, '')
+
+	@classmethod
+	def fromEnvelope(cls, flags, target, name, questioner, id, payload):
+		return cls()
+
+for _kind in (Function, Method, Event, Result, Stop, Batch):
+	_messageKinds[_kind.kind] = _kind
 
 class Error(Exception):
 	pass
+
+class Timeout(Error):
+	"""
+	\brief A function call did not return before its deadline
+	"""
+	pass
+
+class PluginGroup(object):
+	"""
+	\brief Runs several plugins in one process
+
+	The group receives the requests and answers for all its members from the PluginManager
+	and hands them to the member they are addressed to.
+	Each member takes its requests on a thread of its own, so a member that blocks
+	by its QueuePolicy does not hold up the requests to the other members.
+	Calls between the members do not leave the process.
+	"""
+	def __init__(self, pipes):
+		self.pipes = pipes #The communication pipes of the group to the PluginManager
+		self.members = {} #The plugins of the group by name
+		self.inboxes = {} #The (requests, condition) received for each member and not handed to it yet
+		self.sendLock = threading.Lock() #Serializes the writes of all members to the outgoing pipe
+		self.answerLock = threading.Lock() #Serializes the answers of all members to the incoming pipe
+
+	def run(self):
+		"""
+		\brief Start the members and receive for them until the group is stopped
+		"""
+		deliveries = []
+		for name, member in self.members.items():
+			member.run()
+			self.inboxes[name] = (collections.deque(), threading.Condition())
+			delivery = threading.Thread(target = self.__deliver, args = (name,))
+			delivery.daemon = True
+			delivery.start()
+			deliveries.append(delivery)
+		answerThread = threading.Thread(target = self.__receiveAnswers)
+		answerThread.daemon = True
+		answerThread.start()
+		running = True
+		while running:
+			try:
+				task = receiveMessage(self.pipes[0])
+			except (EOFError, IOError):
+				break
+			if isinstance(task, Stop):
+				for name in self.members:
+					self.__post(name, Stop())
+				for delivery in deliveries:
+					delivery.join()
+				#the jobs before the Stop still receive the calls back into them
+				while any(member._working() for member in self.members.values()):
+					try:
+						if not self.pipes[0].poll(0.05):
+							continue
+						task = receiveMessage(self.pipes[0])
+					except (EOFError, IOError):
+						break
+					if task.name[0] in self.members:
+						self.members[task.name[0]]._enqueue(task)
+				for member in self.members.values():
+					member._joinWorkers()
+				running = False
+			elif task.name[0] in self.members:
+				self.__post(task.name[0], task)
+			else:
+				print('PluginGroup: no member ' + str(task.name[0]) + ' for ' + str(task.name[1]))
+
+	def __post(self, name, task):
+		"""
+		\brief Hand a request to the delivery thread of a member
+		\param name The name of the member
+		\param task The request
+		"""
+		inbox, ready = self.inboxes[name]
+		ready.acquire()
+		inbox.append(task)
+		ready.notify()
+		ready.release()
+
+	def __deliver(self, name):
+		"""
+		\brief Put the received requests into the queue of a member until it is stopped
+		\param name The name of the member
+		"""
+		inbox, ready = self.inboxes[name]
+		member = self.members[name]
+		while True:
+			ready.acquire()
+			while not inbox:
+				ready.wait()
+			task = inbox.popleft()
+			ready.release()
+			member._enqueue(task)
+			if isinstance(task, Stop):
+				return
+
+	def __receiveAnswers(self):
+		"""
+		\brief Receive the answers for all members
+		"""
+		while True:
+			try:
+				answer = receiveMessage(self.pipes[1])
+			except (EOFError, IOError):
+				break
+			if answer.questioner in self.members:
+				self.members[answer.questioner]._receiveAnswer(answer)
+			else:
+				print('PluginGroup: dropped answer for ' + str(answer.questioner))
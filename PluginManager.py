@@ -1,8 +1,20 @@
 from PluginInterface import *
 from multiprocessing import Process, Pipe
+from ForkServer import ForkServer, ForkedProcess
+from Metrics import Metrics, sizeBuckets
+from Tracing import createTraceFile
 import threading
 import os
 import traceback
+import cPickle
+import select
+import struct
+import fcntl
+import errno
+import collections
+import itertools
+import time
+import heapq
 
 """
 \file PluginManager.py
@@ -15,11 +27,45 @@ class PluginManager(object):
 	
 	Each plugin is registered here and will be started from here!
 	"""
-	def __init__(self):
+	def __init__(self, router = False, preload = None, traceFile = None):
 		"""
 		\brief Initialize with no plugins
+		\param router Route all messages in a single thread instead of two threads per plugin
+		\param preload Start the plugins from a fork server that imported these modules,
+			True for the common modules (ForkServer.defaultPreload),
+			None to start each plugin as a fresh multiprocessing.Process
+		\param traceFile The file to write the spans of all requests to, None for no tracing,
+			the plugins loaded afterwards record their spans there
 		"""
 		self.plugins = {} #The map from plugin names to plugin contents
+		self.traceFile = traceFile #The trace file of the plugins, if tracing
+		if traceFile != None:
+			createTraceFile(traceFile)
+		self.__forkServer = None #The fork server that starts the plugin processes, if any
+		if preload != None:
+			self.__forkServer = ForkServer(preload != True and preload or None)
+		self.__router = None #The router that multiplexes all pipes in router mode
+		#the map lifecycle (EndRound, EndMap, MapListModified, BeginMap, ...) stays in one lane,
+		#a later event of it must not overtake an earlier one
+		self.eventPriorities = {'PlayerManialinkPageAnswer' : Priority.INTERACTIVE,
+								'PlayerChat' : Priority.INTERACTIVE} #The Priority of events by name
+		self.__callIds = itertools.count(1) #The source of the ids of the calls of the manager to plugins
+		self.__pending = {} #The callbacks for the results of the calls of the manager, by call id
+		self.__pendingLock = threading.Lock()
+		self.metrics = Metrics() #The metrics of the routing
+		self.__waits = WaitGraph() #The function calls between plugins that wait for their result
+		self.__flights = {} #The (leader, request, deadline, followers) of the call in flight by (target, name, args)
+		self.__flightKeys = {} #The key of each call in flight by (questioner, call id)
+		self.__flightLock = threading.Lock()
+		self.__states = {} #The published state of each plugin, a dict by key, by plugin name
+		self.__stateSubscribers = {} #The callback of each plugin that replicates the state of a plugin, by plugin name
+		self.__stateLock = threading.Lock() #Keeps the changes of the state and their pushes in one order
+		self.__listenedLock = threading.Lock() #Keeps the pushes of the listened events in the order of the changes
+		self.stopTimeout = 30 #The seconds a stopped plugin may take to finish its jobs before it is terminated
+		self.flightSlack = 0.1 #The seconds the deadline of a call may be later than the one of the flight it joins
+		if router:
+			self.__router = Router()
+			self.__router.start()
 
 	def loadPlugin(self, caller, fileName, args = None):
 		"""
@@ -28,31 +74,192 @@ class PluginManager(object):
 		\param fileName The filename of the plugin to load
 		\param args Startup arguments to this plugin
 		"""
+		self.__StartPlugin(self.__createPlugin(fileName, args))
+
+	def loadPlugins(self, caller, plugins):
+		"""
+		\brief Load several plugins, each is initialized as soon as the plugins it depends on are ready
+		\param caller The name of the plugin that requests this load
+		\param plugins The list of (fileName, args) of the plugins to load
+		\return The PluginStartup, its wait method waits until all plugins are ready
+
+		All processes are started at once, then each plugin reports its dependencies (getDependencies).
+		A plugin is initialized when all plugins it depends on have returned from their initialize,
+		plugins that do not depend on each other are initialized at the same time.
+		Dependencies that are neither in the list nor loaded already are ignored.
+		"""
+		names = [self.__createPlugin(fileName, args) for fileName, args in plugins]
+		startup = PluginStartup(names)
+		for name in names:
+			self.__StartPlugin(name, False)
+		for name in names:
+			plugin = self.plugins[name]
+			self.__callPlugin(plugin, 'getDependencies', (plugin.args,),
+				lambda answer, name = name: self.__dependenciesKnown(startup, name, answer))
+		return startup
+
+	def __createPlugin(self, fileName, args):
+		"""
+		\brief Create the process and the manager side of a plugin without starting it
+		\param fileName The filename of the plugin
+		\param args Startup arguments to this plugin
+		\return The name of the plugin
+		"""
 		pipe0, childPipe0 = Pipe()
 		pipe1, childPipe1 = Pipe()
-		p = Process(target = loadPlugin, args = (fileName, (childPipe0, childPipe1), args))
+		p = self.__process(loadPlugin, (fileName, (childPipe0, childPipe1), args))
 		pluginName = os.path.splitext(os.path.split(fileName)[1])[0]
+		self.plugins[pluginName] = PluginElement(pluginName, [], [], (pipe0, pipe1), 
+												self.__listenerThreads(pluginName), p, fileName, args)
+		self.plugins[pluginName].childPipes = (childPipe0, childPipe1)
+		return pluginName
+
+	def __dependenciesKnown(self, startup, name, answer):
+		"""
+		\brief Store the dependencies a plugin reported and initialize the plugins that may start now
+		"""
+		try:
+			depends = list(answer.getValue())
+		except Exception as e:
+			print('Could not get the dependencies of ' + name + ': ' + str(e))
+			depends = []
+		self.plugins[name].depends = depends
+		for dependency in depends:
+			if not dependency in startup.names and not dependency in self.plugins:
+				print('Plugin ' + name + ' depends on ' + dependency + ', which is not loaded')
+		self.__initialize(startup, startup.dependenciesKnown(name, 
+							[d for d in depends if d in startup.names]))
+
+	def __initialize(self, startup, names):
+		"""
+		\brief Initialize the plugins of the startup
+		\param startup The PluginStartup
+		\param names The plugins whose dependencies are ready
+		"""
+		for name in names:
+			plugin = self.plugins[name]
+			self.__callPlugin(plugin, 'initialize', (plugin.args,),
+				lambda answer, name = name: self.__initialized(startup, name, answer))
+
+	def __initialized(self, startup, name, answer):
+		"""
+		\brief Mark the plugin ready and initialize the plugins that waited for it
+		"""
+		try:
+			answer.getValue()
+		except Exception as e:
+			print('Initialize of ' + name + ' failed: ' + str(e))
+		print('Started plugin ' + name)
+		self.__initialize(startup, startup.initialized(name))
+
+	def __callPlugin(self, plugin, name, args, callback):
+		"""
+		\brief Call a function of a plugin without waiting for the result
+		\param plugin The plugin to call
+		\param name The name of the function
+		\param args The arguments to the function
+		\param callback Called with the Result, in the thread that receives the answers of the plugin
+		"""
+		self.__sendCall(plugin, Function((plugin.name, name), args), callback)
+
+	def __sendCall(self, plugin, function, callback):
+		"""
+		\brief Send a call of the manager to a plugin
+		\param plugin The plugin to call
+		\param function The Function or Batch
+		\param callback Called with the Result
+		"""
+		function.id = self.__callIds.next()
+		self.__pendingLock.acquire()
+		self.__pending[function.id] = callback
+		self.__pendingLock.release()
+		if not self.__sendRequest(plugin, function.encode(), function.priority):
+			self.__pendingLock.acquire()
+			self.__pending.pop(function.id, None)
+			self.__pendingLock.release()
+			callback(Result(function, Error('Plugin ' + plugin.name + ' is not running'), True))
+
+	def loadPluginGroup(self, caller, plugins):
+		"""
+		\brief Load several plugins into one process
+		\param caller The name of the plugin that requests this load
+		\param plugins The list of (fileName, args) of the plugins to load
+
+		The plugins of a group call each other directly without pickling and without the pipes,
+		calls to and from plugins outside of the group work as usual.
+		The group is unloaded and restarted as a whole.
+		"""
+		pipe0, childPipe0 = Pipe()
+		pipe1, childPipe1 = Pipe()
+		p = self.__process(loadPluginGroup, (plugins, (childPipe0, childPipe1)))
+		names = [os.path.splitext(os.path.split(fileName)[1])[0] for fileName, args in plugins]
+		threads = self.__listenerThreads(names[0])
+		for name, (fileName, args) in zip(names, plugins):
+			self.plugins[name] = PluginElement(name, [], [], (pipe0, pipe1), threads, p, fileName, args)
+			self.plugins[name].group = names
+			self.plugins[name].childPipes = (childPipe0, childPipe1)
+			#the members share the pipes, so the writes of all of them have to be serialized together
+			self.plugins[name].req_lock = self.plugins[names[0]].req_lock
+			self.plugins[name].ans_lock = self.plugins[names[0]].ans_lock
+		self.__StartPlugin(names[0])
+
+	def __process(self, target, args):
+		"""
+		\brief Create the process of a plugin
+		\param target The function the process runs
+		\param args The arguments to the function
+		\return The process, not started yet
+		"""
+		if self.__forkServer != None:
+			return ForkedProcess(self.__forkServer, target, args)
+		return Process(target = target, args = args)
+
+	def __listenerThreads(self, pluginName):
+		"""
+		\brief Create the listener threads for the pipes of the plugin
+		\param pluginName The name of the plugin
+		\return The threads, none in router mode
+		"""
+		if self.__router != None:
+			return ()
 		t1 = threading.Thread(target = self.__listenForRequests, args = (pluginName,))
 		t1.deamon = True
 		t2 = threading.Thread(target = self.__listenForAnswers, args = (pluginName,))
 		t2.deamon = True
-		self.plugins[pluginName] = PluginElement(pluginName, [], [], (pipe0, pipe1), (t1, t2), p, fileName, args)
-		self.__StartPlugin(pluginName, args)
+		return (t1, t2)
 
-	def __StartPlugin(self, name, args = None):
+	def __StartPlugin(self, name, initialize = True):
 		"""
 		\brief Start the plugin process
 		\param name The name of the plugin to start
-		\param args The startup arguments of this plugin
+		\param initialize Initialize the plugin right away? Otherwise the caller has to do it
+
+		For a group the whole group is started.
 		"""
 		plugin = self.plugins[name]
-		plugin.running = True
-		plugin.threads[0].start()
-		plugin.threads[1].start()
+		members = [self.plugins[member] for member in plugin.group or [name]]
+		for member in members:
+			member.running = True
+		if self.__router == None:
+			plugin.threads[0].start()
+			plugin.threads[1].start()
+		else:
+			self.__router.register(plugin.pipes[0], 
+				lambda data: self.__routeAnswer(plugin, decodeMessage(data)))
+			self.__router.register(plugin.pipes[1], 
+				lambda data: self.__routeRequest(plugin, decodeMessage(data)))
 		plugin.process.start()
-		plugin.pipes[0].send(True)
-		plugin.pipes[0].send(Method('initialize', (args,)))
-		print('Started plugin ' + name)
+		#only the plugin keeps its ends open, so its end is noticed when it exits
+		for pipe in plugin.childPipes:
+			pipe.close()
+		self.__sendRequest(plugin, cPickle.dumps({'traceFile' : self.traceFile}, cPickle.HIGHEST_PROTOCOL))
+		for member in members:
+			self.__sendListenedEvents(member)
+		if not initialize:
+			return
+		for member in members:
+			self.__sendRequest(plugin, Method((member.name, 'initialize'), (member.args,)).encode())
+			print('Started plugin ' + member.name)
 
 	def __StopPlugin(self, name):
 		"""
@@ -64,19 +271,33 @@ class PluginManager(object):
 		except KeyError:
 			print('Could not stop unknown plugin ' + str(name))
 			return False
-		plugin.req_lock.acquire()
-		plugin.pipes[0].send(Stop())
-		plugin.req_lock.release()
+		members = [self.plugins[member] for member in plugin.group or [name]]
+		for member in members:
+			#the jobs before the Stop still make calls and get answers until the process ends
+			member.stopping = True
+		self.__sendRequest(plugin, Stop().encode(), Stop.priority)
 
-		plugin.running = False
-		plugin.process.join()
+		for member in members:
+			member.running = False
+		plugin.process.join(self.stopTimeout)
+		if plugin.process.is_alive():
+			print('Plugin ' + name + ' did not stop within ' + str(self.stopTimeout) + ' s, terminating it')
+			plugin.process.terminate()
+			plugin.process.join()
+		for member in members:
+			member.stopping = False
+			self.__dropFlights(member.name)
+		if self.__router != None:
+			self.__router.unregister(plugin.pipes[0])
+			self.__router.unregister(plugin.pipes[1])
 
 	def unloadPlugin(self, name):
 		"""
 		\brief Unload a plugin from the manager
 		\param name The name of the plugin to unload
 		
-		This first stops the plugin and then removes it from the plugin list
+		This first stops the plugin and then removes it from the plugin list.
+		The plugins of a group are unloaded together.
 		"""
 		
 		self.__StopPlugin(name)
@@ -84,10 +305,15 @@ class PluginManager(object):
 			plugin = self.plugins[name]
 		except KeyError:
 			return False
-		for p in self.plugins.items():
-			for l in p[1].listeners.items():
-				p[1].listeners[l[0]] = (l[1], filter(lambda x: plugin != x[0],l[1]))
-		del self.plugins[name]
+		members = [self.plugins[member] for member in plugin.group or [name]]
+		for p in self.plugins.values():
+			for eventName, listeners in p.listeners.items():
+				p.listeners[eventName] = filter(lambda x: not x[0] in members, listeners)
+				self.__updateDispatch(p, eventName)
+		for member in members:
+			self.__waits.forget(member.name)
+			self.__forgetStates(member.name)
+			del self.plugins[member.name]
 		print('Unloaded plugin list: ', self.plugins)
 
 	def restartPlugin(self, caller, name):
@@ -102,12 +328,87 @@ class PluginManager(object):
 			plugin = self.plugins[name]
 			args = plugin.args
 			fileName = plugin.fileName
+			group = plugin.group and [(self.plugins[member].fileName, self.plugins[member].args) 
+									for member in plugin.group]
 
-			self.unloadPlugin(name)
-			self.loadPlugin(caller, fileName, args)
+			#stopping waits for the old process to end, which must not block the thread that routes
+			if group:
+				threading.Thread(target = self.__reloadGroup, args = (caller, name, group)).start()
+			elif plugin.process.is_alive():
+				self.__callPlugin(plugin, 'getSnapshot', (), 
+					lambda answer: self.__snapshotTaken(name, answer))
+			else:
+				threading.Thread(target = self.__replacePlugin, args = (name, None)).start()
 		else:
 			print('Plugin ' + str(name) + ' not found in list for restart')
 
+	def __reloadGroup(self, caller, name, group):
+		"""
+		\brief Unload a PluginGroup and load its plugins again
+		\param caller The one demanding the restart
+		\param name The name of a plugin of the group
+		\param group The (fileName, args) of the plugins of the group
+		"""
+		self.unloadPlugin(name)
+		self.loadPluginGroup(caller, group)
+
+	def __snapshotTaken(self, name, answer):
+		"""
+		\brief Replace the plugin by a new instance once its snapshot arrived
+		\param name The name of the plugin
+		\param answer The Result of getSnapshot
+
+		Replacing waits for the old process to end, which must not block the thread that routes.
+		"""
+		try:
+			snapshot = answer.getValue()
+		except Exception as e:
+			print('Could not get the snapshot of ' + name + ': ' + str(e))
+			snapshot = None
+		threading.Thread(target = self.__replacePlugin, args = (name, snapshot)).start()
+
+	def __replacePlugin(self, name, snapshot):
+		"""
+		\brief Stop the plugin and start a new instance of it in its place
+		\param name The name of the plugin
+		\param snapshot The state of the old instance or None to initialize the new one from scratch
+
+		The subscriptions to the events of the plugin are kept.
+		With a snapshot the subscriptions of the plugin are kept as well 
+		and the new instance is started with restoreSnapshot instead of initialize.
+		"""
+		old = self.plugins[name]
+		self.__StopPlugin(name)
+		self.__createPlugin(old.fileName, old.args)
+		plugin = self.plugins[name]
+		plugin.listeners = old.listeners
+		for p in self.plugins.values():
+			for eventName, listeners in p.listeners.items():
+				if snapshot != None:
+					p.listeners[eventName] = [(l is old and plugin or l, c) for l, c in listeners]
+				else:
+					p.listeners[eventName] = [(l, c) for l, c in listeners if not l is old]
+				self.__updateDispatch(p, eventName)
+		if snapshot != None:
+			plugin.singleFlight = old.singleFlight
+		else:
+			self.__forgetStates(name)
+		self.__StartPlugin(name, snapshot == None)
+		if snapshot != None:
+			self.__resendStates(name)
+			self.__callPlugin(plugin, 'restoreSnapshot', (plugin.args, snapshot),
+				lambda answer: self.__snapshotRestored(name, answer))
+
+	def __snapshotRestored(self, name, answer):
+		"""
+		\brief Report the outcome of restoreSnapshot
+		"""
+		try:
+			answer.getValue()
+			print('Started plugin ' + name + ' from snapshot')
+		except Exception as e:
+			print('Restoring the snapshot of ' + name + ' failed: ' + str(e))
+
 
 	def shutdown(self):
 		"""
@@ -118,6 +419,21 @@ class PluginManager(object):
 		for plugin in self.plugins.keys():
 			self.__StopPlugin(plugin)
 		del self.plugins
+		if self.__router != None:
+			self.__router.stop()
+		if self.__forkServer != None:
+			self.__forkServer.stop()
+
+	def getMetrics(self, caller):
+		"""
+		\brief Get the metrics of the PluginManager
+		\param caller The calling plugin
+		\return The snapshot of the Metrics, see Metrics.snapshot
+		"""
+		gauges = [(('tmc_plugins', ()), len(self.plugins))]
+		if self.__router != None:
+			gauges.append((('tmc_router_stalls', ()), self.__router.stalls))
+		return self.metrics.snapshot(gauges)
 
 	def PluginList(self, caller):
 		"""
@@ -136,69 +452,129 @@ class PluginManager(object):
 		"""
 		try:
 			plugin = self.plugins[pluginName]
-			while plugin.running:
-				request = plugin.pipes[1].recv()
-
-				if isinstance(request, Event):
-					#print('Processing Event ' + str(request.name))
-					if request.name in plugin.listeners:
-						for listener in plugin.listeners[request.name]:
-							listener[0].req_lock.acquire()
-							method = Method(listener[1], None)
-							method.args = request.args
-							method.questioner = plugin.name
-							listener[0].pipes[0].send(method)
-							listener[0].req_lock.release()
-
-				elif isinstance(request, Method):
-					if request.name[0] == None:
-						#print('Processing Method ' + str(request.name[1] + str(request.getArgs())))
-						try:
-							method = getattr(self, request.name[1])
-						except:
-							print('Could not call method PluginManager.' + 
-								str(request.name[1]) + str(request.getArgs()))
-						method(plugin, *request.getArgs())
-					else:
-						try:
-							recipient = self.plugins[request.name[0]]
-							recipient.req_lock.acquire()
-							request.name = request.name[1]
-							request.questioner = plugin.name
-							recipient.pipes[0].send(request)
-							recipient.req_lock.release()
-						except KeyError:
-							print('Could not pass method request to ' + request.name[0] + '.' + request.name[1])
-
-				elif isinstance(request, Function):
-					if request.name[0] == None:
-						#print('Processing Function ' + str(request.name[1]) + str(request.getArgs()))
-						try:
-							function = getattr(self, request.name[1])
-						except:
-							print('Could not call function PluginManager.' + 
-								str(request.name[1]) + str(request.getArgs()))
-						plugin.pipes[1].send(Result(request, function(plugin, *request.getArgs())))
-					elif request.name[0] in self.plugins:
-						recipient = self.plugins[request.name[0]]
-						recipient.req_lock.acquire()
-						request.name = request.name[1]
-						request.questioner = plugin.name
-						recipient.pipes[0].send(request)
-						recipient.req_lock.release()
-					else:
-						plugin.pipes[1].send(Error())
-				elif isinstance(request, Stop):
-					plugin.running = False
-				else:
-					print('Could not process ' + str(request))
+			while plugin.running or plugin.stopping:
+				self.__routeRequest(plugin, receiveMessage(plugin.pipes[1]))
 		except KeyboardInterrupt:
 			print('Interrupted')
 			self.__StopPlugin(pluginName)
-	#	except Exception as e:
-	#		print(self, pluginName, e, plugin)
-		finally:
-			pass
+		except (EOFError, IOError):
+			plugin.running = False
+
+	def __routeRequest(self, plugin, request):
+		"""
+		\brief Route one request that the plugin sent
+		\param plugin The plugin that sent the request
+		\param request The decoded request
+		"""
+		if plugin.group and request.questioner in plugin.group:
+			plugin = self.plugins[request.questioner]
+		if isinstance(request, Function):
+			kind = request.__class__.__name__.lower()
+			target = isinstance(request.name, tuple) and (request.name[0] or 'PluginManager') or request.name
+			self.metrics.count('tmc_messages_total', (('type', kind), ('source', plugin.name), ('target', target)))
+			self.metrics.observe('tmc_payload_bytes', (('type', kind),), len(request.args), sizeBuckets)
+		if isinstance(request, Event):
+			#print('Processing Event ' + str(request.name))
+			priority = self.eventPriorities.get(request.name, request.priority)
+			for listener, header in plugin.dispatch.get(request.name, ()):
+				self.__sendRequest(listener, stampHeader(header, priority, request.traceId, request.spanId) 
+									+ request.args, priority)
+
+		elif isinstance(request, Method):
+			if request.name[0] == None:
+				#print('Processing Method ' + str(request.name[1] + str(request.getArgs())))
+				try:
+					method = getattr(self, request.name[1])
+				except:
+					print('Could not call method PluginManager.' + 
+						str(request.name[1]) + str(request.getArgs()))
+				method(plugin, *request.getArgs())
+			else:
+				try:
+					recipient = self.plugins[request.name[0]]
+					request.questioner = plugin.name
+					self.__sendRequest(recipient, request.encode(), request.priority)
+				except KeyError:
+					print('Could not pass method request to ' + request.name[0] + '.' + request.name[1])
+
+		elif isinstance(request, Batch):
+			self.__routeBatch(plugin, request)
+
+		elif isinstance(request, Function):
+			if request.name[0] == None:
+				#print('Processing Function ' + str(request.name[1]) + str(request.getArgs()))
+				try:
+					function = getattr(self, request.name[1])
+				except:
+					print('Could not call function PluginManager.' + 
+						str(request.name[1]) + str(request.getArgs()))
+				result = Result(request, function(plugin, *request.getArgs()))
+				self.__sendAnswer(plugin, result.encode())
+			elif request.name[0] in self.plugins:
+				recipient = self.plugins[request.name[0]]
+				request.questioner = plugin.name
+				if request.name[1] in recipient.singleFlight and self.__joinFlight(plugin, request):
+					return
+				cycle = self.__waits.add(plugin.name, request.id, recipient.name, request.traceId, 
+									request.deadline)
+				if cycle != None:
+					self.metrics.count('tmc_call_cycles_total', (('plugin', plugin.name),))
+					print('Possible deadlock, function calls of different requests wait in a cycle: ' 
+						+ ' -> '.join(cycle))
+				nested = recipient.stopping and self.__waits.waits(recipient.name, request.traceId)
+				if not self.__sendRequest(recipient, request.encode(), request.priority, nested):
+					#e.g. it is stopping or being restarted, the caller must not wait for an answer that never comes
+					self.__routeAnswer(recipient, Result(request, 
+						Error('Plugin ' + recipient.name + ' is not running'), True))
+			else:
+				self.__sendAnswer(plugin, Result(request, 
+					Error('Unknown plugin ' + str(request.name[0])), True).encode())
+		elif isinstance(request, Stop):
+			plugin.running = False
+		else:
+			print('Could not process ' + str(request))
+
+	def __routeBatch(self, plugin, request):
+		"""
+		\brief Split a batch of calls by the called plugins and answer with all results together
+		\param plugin The calling plugin
+		\param request The Batch
+		"""
+		calls = request.getArgs()
+		parts = {} #The indices of the calls to each plugin
+		for index, (name, args) in enumerate(calls):
+			parts.setdefault(name[0], []).append(index)
+		batch = PendingBatch(len(calls), len(parts), 
+							lambda results: self.__sendAnswer(plugin, Result(request, results).encode()))
+		for target, indices in parts.items():
+			if target == None:
+				batch.answer(indices, [self.__callManager(plugin, calls[index]) for index in indices])
+			elif not target in self.plugins:
+				batch.answer(indices, [(True, Error('Unknown plugin ' + str(target)))] * len(indices))
+			else:
+				part = Batch((target, 'callMany'), [calls[index] for index in indices])
+				#the callee orders it with the single calls of the caller, the answer still comes to the manager
+				part.questioner = plugin.name
+				part.priority = request.priority
+				part.traceId = request.traceId
+				part.spanId = request.spanId
+				part.deadline = request.deadline
+				self.__sendCall(self.plugins[target], part, 
+								lambda answer, indices = indices: batch.answer(indices, answer))
+
+	def __callManager(self, plugin, call):
+		"""
+		\brief Make a call of a batch to the PluginManager
+		\param plugin The calling plugin
+		\param call The ((None, name), pickled args) of the call
+		\return The (error, value) of the call
+		"""
+		name, args = call
+		try:
+			return (False, getattr(self, name[1])(plugin, *cPickle.loads(args)))
+		except Exception as e:
+			print('Could not call function PluginManager.' + str(name[1]) + ': ' + repr(e))
+			return (True, Error('PluginManager.' + str(name[1]) + ': ' + repr(e)))
 
 	def __listenForAnswers(self, pluginName):
 		"""
@@ -210,22 +586,164 @@ class PluginManager(object):
 		"""
 		try:
 			plugin = self.plugins[pluginName]
-			while plugin.running:
-				answer = plugin.pipes[0].recv()
-
-				if isinstance(answer, Stop):
-					plugin.running = False
-				else:
-					q = answer.function.questioner
-					if q in self.plugins:
-						q = self.plugins[q]
-						q.pipes[1].send(answer)
+			while plugin.running or plugin.stopping:
+				self.__routeAnswer(plugin, receiveMessage(plugin.pipes[0]))
 		except KeyboardInterrupt:
 			self.__StopPlugin(pluginName)
+		except (EOFError, IOError):
+			plugin.running = False
 		except Exception as e:
 			print(self, pluginName, e)
+
+	def __routeAnswer(self, plugin, answer):
+		"""
+		\brief Route one answer of the plugin back to the questioner
+		\param plugin The plugin that answered
+		\param answer The decoded answer
+		"""
+		if isinstance(answer, Stop):
+			plugin.running = False
+		elif answer.questioner == None:
+			self.__pendingLock.acquire()
+			callback = self.__pending.pop(answer.id, None)
+			self.__pendingLock.release()
+			if callback != None:
+				callback(answer)
+		else:
+			q = answer.questioner
+			self.metrics.count('tmc_messages_total', (('type', 'result'), ('source', plugin.name), ('target', q)))
+			self.metrics.observe('tmc_payload_bytes', (('type', 'result'),), len(answer.value), sizeBuckets)
+			self.__waits.remove(q, answer.id)
+			followers = self.__landFlight(q, answer.id)
+			if q in self.plugins:
+				self.__sendAnswer(self.plugins[q], answer.encode())
+			for follower, request in followers:
+				if answer.error:
+					#a Timeout or Error of the leader is not shared, the call is made on its own
+					self.__routeRequest(follower, request)
+					continue
+				#the same result for every call that joined the flight
+				answer.questioner = follower.name
+				answer.id = request.id
+				self.__sendAnswer(follower, answer.encode())
+
+	def enableSingleFlight(self, caller, functionName):
+		"""
+		\brief Let identical concurrent calls to a function of the calling plugin share one execution
+		\param caller The calling plugin
+		\param functionName The name of the function, e.g. GetPlayerList
+
+		While a call is in flight, calls with the same arguments wait for its result
+		instead of being forwarded. Use it for functions without side effects
+		that many plugins call at the same moment, e.g. on BeginMap.
+		"""
+		caller.singleFlight.add(functionName)
+
+	def __joinFlight(self, plugin, request):
+		"""
+		\brief Let a call wait for an identical call in flight
+		\param plugin The calling plugin
+		\param request The function call
+		\return True if the call joined a flight, False if it has to be forwarded
+		
+		A call only joins a flight whose deadline does not end before its own
+		(give or take flightSlack), otherwise it would wait for the Timeout of the leader.
+		Such a call is forwarded on its own.
+		"""
+		key = (request.name, request.args)
+		self.__flightLock.acquire()
+		try:
+			flight = self.__flights.get(key)
+			if flight != None:
+				deadline, followers = flight[2], flight[3]
+				if deadline != 0 and (request.deadline == 0 or request.deadline > deadline + self.flightSlack):
+					return False
+				followers.append((plugin, request))
+				self.metrics.count('tmc_single_flight_joined_total', (('target', request.name[0]), 
+																	('function', request.name[1])))
+				return True
+			self.__flights[key] = (plugin, request, request.deadline, [])
+			self.__flightKeys[(plugin.name, request.id)] = key
+			return False
+		finally:
+			self.__flightLock.release()
+
+	def __landFlight(self, questioner, id):
+		"""
+		\brief End the flight of a call whose result arrived
+		\param questioner The name of the calling plugin
+		\param id The id of the call
+		\return The (plugin, request) of the calls that wait for the same result
+		"""
+		self.__flightLock.acquire()
+		try:
+			key = self.__flightKeys.pop((questioner, id), None)
+			if key == None:
+				return ()
+			return self.__flights.pop(key)[3]
+		finally:
+			self.__flightLock.release()
+
+	def __dropFlights(self, name):
+		"""
+		\brief End the flights of the calls to a plugin that stopped
+		\param name The name of the stopped plugin
+		
+		The plugin will not answer these calls anymore, so the leaders
+		and their followers get an Error instead of waiting for it.
+		"""
+		self.__flightLock.acquire()
+		try:
+			keys = [key for key in self.__flights if key[0][0] == name]
+			flights = [self.__flights.pop(key) for key in keys]
+			for leader, request, deadline, followers in flights:
+				self.__flightKeys.pop((leader.name, request.id), None)
 		finally:
-			pass
+			self.__flightLock.release()
+		for leader, request, deadline, followers in flights:
+			for plugin, call in [(leader, request)] + followers:
+				self.__waits.remove(plugin.name, call.id)
+				self.__sendAnswer(plugin, Result(call, 
+					Error('Plugin ' + name + ' stopped before answering ' + call.name[1]), True).encode())
+
+	def __sendRequest(self, plugin, data, priority = Priority.NORMAL, nested = False):
+		"""
+		\brief Write an envelope to the request pipe of the plugin
+		\param plugin The receiving plugin
+		\param data The envelope
+		\param priority The Priority of the request, the router sends the more urgent ones first
+		\param nested Is it a call back into a job of the plugin that waits for its result?
+			A stopping plugin still receives it, the job has to finish.
+		\return False if the plugin is not running and the request was dropped
+		"""
+		if not plugin.running and not (nested and plugin.stopping):
+			return False
+		if self.__router != None:
+			self.__router.send(plugin.pipes[0], data, priority)
+		else:
+			plugin.req_lock.acquire()
+			try:
+				plugin.pipes[0].send_bytes(data)
+			finally:
+				plugin.req_lock.release()
+		return True
+
+	def __sendAnswer(self, plugin, data):
+		"""
+		\brief Write an envelope to the answer pipe of the plugin
+		\param plugin The receiving plugin
+		\param data The envelope
+		"""
+		if not plugin.running and not plugin.stopping:
+			return
+		if self.__router != None:
+			self.__router.send(plugin.pipes[1], data, Priority.INTERACTIVE)
+		else:
+			plugin.ans_lock.acquire()
+			try:
+				plugin.pipes[1].send_bytes(data)
+			finally:
+				plugin.ans_lock.release()
 
 	def subscribeEvent(self, caller, pluginName, eventName, callbackMethod):
 		"""
@@ -240,6 +758,7 @@ class PluginManager(object):
 			if not eventName in plugin.listeners:
 				plugin.listeners[eventName] = []
 			plugin.listeners[eventName].append((caller, callbackMethod))
+			self.__updateDispatch(plugin, eventName)
 			return True
 		except Exception as e:
 			print('Error while subscribing to', pluginName, eventName, callbackMethod)
@@ -258,7 +777,376 @@ class PluginManager(object):
 		item = (caller, callbackMethod)
 		if item in plugin.listeners[eventName]:
 			plugin.listeners[eventName].remove(item)
+			self.__updateDispatch(plugin, eventName)
+
+	def __updateDispatch(self, plugin, eventName):
+		"""
+		\brief Precompute the deliveries of an event after its listeners changed
+		\param plugin The plugin that signals the event
+		\param eventName The name of the event
+
+		Each listener gets the envelope header of the method call to its callback,
+		so an event only needs the header stamped with its priority and trace and put in front of its payload,
+		which was pickled once by the signalling plugin.
+		The plugin is told when the event gains its first or loses its last listener.
+		"""
+		listened = eventName in plugin.dispatch
+		dispatch = [(listener, encodeMessage(Method.kind, Function.TARGETED, Priority.NORMAL, 0, 0, 0, 
+											listener.name, callbackMethod, plugin.name, 0, ''))
+					for listener, callbackMethod in plugin.listeners.get(eventName, ())]
+		if len(dispatch) > 0:
+			plugin.dispatch[eventName] = dispatch
+		else:
+			plugin.dispatch.pop(eventName, None)
+		if (eventName in plugin.dispatch) != listened:
+			self.__sendListenedEvents(plugin)
+
+	def __sendListenedEvents(self, plugin):
+		"""
+		\brief Tell a plugin which of its events have listeners
+		\param plugin The plugin that signals the events
+
+		The plugin does not send the events nobody listens to, see PluginInterface.hasListeners.
+		The whole set is sent each time, so the last push is the current one.
+		"""
+		self.__listenedLock.acquire()
+		try:
+			self.__sendRequest(plugin, Method((plugin.name, PluginInterface.LISTENED), 
+											(plugin.dispatch.keys(), )).encode())
+		finally:
+			self.__listenedLock.release()
 
+	def publishState(self, caller, key, value):
+		"""
+		\brief Set a value of the replicated state of the calling plugin
+		\param caller The publishing plugin
+		\param key The key of the value
+		\param value The new value
+		"""
+		self.__stateLock.acquire()
+		try:
+			self.__states.setdefault(caller.name, {})[key] = value
+			self.__pushState(caller.name, self.__stateSubscribers.get(caller.name, {}), 'set', key, value)
+		finally:
+			self.__stateLock.release()
+
+	def updateState(self, caller, key, changes, removed):
+		"""
+		\brief Change some entries of a dict in the replicated state of the calling plugin
+		\param caller The publishing plugin
+		\param key The key of the dict
+		\param changes The dict of the entries to add or replace
+		\param removed The keys of the entries to remove
+		"""
+		self.__stateLock.acquire()
+		try:
+			entries = self.__states.setdefault(caller.name, {}).setdefault(key, {})
+			entries.update(changes)
+			for entry in removed:
+				entries.pop(entry, None)
+			self.__pushState(caller.name, self.__stateSubscribers.get(caller.name, {}),
+							'update', key, (changes, removed))
+		finally:
+			self.__stateLock.release()
+
+	def subscribeState(self, caller, pluginName, callback):
+		"""
+		\brief Replicate the state of a plugin in the calling plugin
+		\param caller The subscriber
+		\param pluginName The plugin whose state is replicated
+		\param callback The name of the method of the subscriber to call on changes, None for none
+
+		The whole state is pushed first, then every change.
+		The state of a plugin outlives its restarts, so the replicas stay valid meanwhile.
+		"""
+		self.__stateLock.acquire()
+		try:
+			self.__stateSubscribers.setdefault(pluginName, {})[caller.name] = callback
+			self.__pushState(pluginName, {caller.name : callback}, 'snapshot', None,
+							self.__states.get(pluginName, {}))
+		finally:
+			self.__stateLock.release()
+
+	def __pushState(self, pluginName, subscribers, action, key, value):
+		"""
+		\brief Send a change of the state of a plugin to its replicas
+		\param pluginName The plugin whose state changed
+		\param subscribers The callback of each plugin to send to, by plugin name
+		\param action The change, see StateReplica.apply
+		\param key The key of the changed value
+		\param value The value of the change
+
+		The change is pickled once for all subscribers. The pushes always have the same priority,
+		a different one could overtake the earlier changes in the router.
+		"""
+		push = Method(None, (pluginName, action, key, value), pluginName)
+		for name, callback in subscribers.items():
+			if name in self.plugins:
+				push.name = (name, StateReplica.UPDATE + (callback or ''))
+				self.__sendRequest(self.plugins[name], push.encode())
+
+	def __resendStates(self, name):
+		"""
+		\brief Push the whole replicated states to a new instance of a subscriber
+		\param name The name of the plugin
+		"""
+		self.__stateLock.acquire()
+		try:
+			for pluginName, subscribers in self.__stateSubscribers.items():
+				if name in subscribers:
+					self.__pushState(pluginName, {name : subscribers[name]}, 'snapshot', None,
+									self.__states.get(pluginName, {}))
+		finally:
+			self.__stateLock.release()
+
+	def __forgetStates(self, name):
+		"""
+		\brief Drop the state subscriptions of a plugin
+		\param name The name of the plugin
+
+		The state the plugin published is kept for its next instance.
+		"""
+		self.__stateLock.acquire()
+		try:
+			for subscribers in self.__stateSubscribers.values():
+				subscribers.pop(name, None)
+		finally:
+			self.__stateLock.release()
+
+
+class PluginStartup(object):
+	"""
+	\brief The state of the dependency-aware startup of several plugins
+
+	Records when each plugin was initialized and reports the per plugin init times 
+	and the critical path, the chain of dependencies that determined the startup time.
+	"""
+	def __init__(self, names):
+		self.names = set(names) #The plugins of this startup
+		self.started = time.time() #When the startup began
+		self.depends = {} #The dependencies within this startup of each plugin that reported them
+		self.initializing = {} #The time each plugin in initialize was initialized at
+		self.ready = {} #The (start, end) times of initialize of each ready plugin
+		self.__lock = threading.Lock()
+		self.__done = threading.Event()
+
+	def dependenciesKnown(self, name, depends):
+		"""
+		\brief Store the dependencies of the plugin
+		\return The plugins that may be initialized now
+		"""
+		self.__lock.acquire()
+		try:
+			self.depends[name] = depends
+			return self.__release()
+		finally:
+			self.__lock.release()
+
+	def initialized(self, name):
+		"""
+		\brief Mark the plugin ready
+		\return The plugins that may be initialized now
+		"""
+		self.__lock.acquire()
+		try:
+			self.ready[name] = (self.initializing.pop(name), time.time())
+			names = self.__release()
+			if len(self.ready) == len(self.names):
+				self.__report()
+				self.__done.set()
+			return names
+		finally:
+			self.__lock.release()
+
+	def wait(self, timeout = None):
+		"""
+		\brief Wait until all plugins are ready
+		\param timeout The number of seconds to wait at most, None to wait forever
+		\return Are all plugins ready?
+		"""
+		return self.__done.wait(timeout)
+
+	def __release(self):
+		"""
+		\brief Find the plugins whose dependencies are ready, the lock must be held
+		\return The names of the plugins, they count as initializing from now
+		"""
+		names = [name for name, depends in self.depends.items() 
+				if not name in self.initializing and not name in self.ready 
+				and all(d in self.ready for d in depends)]
+		if (len(names) == 0 and len(self.initializing) == 0 and len(self.depends) == len(self.names)
+				and len(self.ready) < len(self.names)):
+			names = [name for name in self.names if not name in self.ready]
+			print('Circular dependencies between ' + ', '.join(names) + ', initializing them anyway')
+		now = time.time()
+		for name in names:
+			self.initializing[name] = now
+		return names
+
+	def __report(self):
+		"""
+		\brief Print the init time of each plugin and the critical path
+		"""
+		for name, (start, end) in sorted(self.ready.items(), key = lambda x: x[1][1]):
+			print('Initialized {0} in {1:.2f} s after waiting {2:.2f} s'.format(name, 
+					end - start, start - self.started))
+		path = [max(self.ready, key = lambda name: self.ready[name][1])]
+		while True:
+			depends = [d for d in self.depends[path[-1]] if self.ready[d][1] <= self.ready[path[-1]][0]]
+			if len(depends) == 0:
+				break
+			path.append(max(depends, key = lambda name: self.ready[name][1]))
+		print('Started {0} plugins in {1:.2f} s, critical path: {2}'.format(len(self.names),
+				self.ready[path[0]][1] - self.started, ' -> '.join('{0} ({1:.2f} s)'.format(name, 
+				self.ready[name][1] - self.ready[name][0]) for name in reversed(path))))
+
+class PendingBatch(object):
+	"""
+	\brief Collects the results of the parts of a batch of calls
+	"""
+	def __init__(self, size, parts, done):
+		"""
+		\param size The number of calls
+		\param parts The number of parts the results arrive in
+		\param done Called with the list of (error, value) of all calls once the last part arrived
+		"""
+		self.results = [None] * size
+		self.__parts = parts
+		self.__done = done
+		self.__lock = threading.Lock()
+
+	def answer(self, indices, results):
+		"""
+		\brief Store the results of a part
+		\param indices The indices of the calls of the part
+		\param results The list of (error, value) or the Result of a Batch
+		"""
+		if isinstance(results, Result):
+			try:
+				results = results.getValue()
+			except Exception as e:
+				results = [(True, e)] * len(indices)
+		self.__lock.acquire()
+		try:
+			for index, result in zip(indices, results):
+				self.results[index] = result
+			self.__parts -= 1
+			done = self.__parts == 0
+		finally:
+			self.__lock.release()
+		if done:
+			self.__done(self.results)
+
+class WaitGraph(object):
+	"""
+	\brief The function calls between plugins that wait for their result
+
+	A cycle of waiting calls of the same request (trace) is resolved by the plugins,
+	their waiting workers process the calls back into them.
+	A cycle through calls of different requests deadlocks when the plugins in it have no idle worker left.
+	"""
+	def __init__(self):
+		self.__calls = {} #The (callee, trace id) of each waiting call by (caller, call id)
+		self.__edges = {} #The number of waiting calls of each (callee, trace id) by caller
+		self.__deadlines = [] #The heap of (deadline, caller, call id) after which the callers gave up
+		self.__lock = threading.Lock()
+
+	def add(self, caller, id, callee, traceId, deadline = 0):
+		"""
+		\brief Add a call that waits for its result
+		\param caller The name of the calling plugin
+		\param id The id of the call
+		\param callee The name of the called plugin
+		\param traceId The trace of the call
+		\param deadline The time.time() after which the caller does not wait anymore, 0 for none
+		\return The plugin names of the cycle through different traces the call closes, None if there is none
+		"""
+		self.__lock.acquire()
+		try:
+			self.__expire(time.time())
+			self.__calls[(caller, id)] = (callee, traceId)
+			edges = self.__edges.setdefault(caller, {})
+			edges[(callee, traceId)] = edges.get((callee, traceId), 0) + 1
+			if deadline:
+				heapq.heappush(self.__deadlines, (deadline, caller, id))
+			return self.__findCycle(caller, callee, traceId)
+		finally:
+			self.__lock.release()
+
+	def __findCycle(self, caller, callee, traceId):
+		"""
+		\brief Search the waiting calls from the callee of a new call back to its caller
+		\return The first path with a call of another trace than the new one, None if there is none
+
+		Each plugin is visited at most twice, before and after a call of another trace was passed.
+		"""
+		stack = [(callee, False, [caller, callee])]
+		visited = set()
+		while stack:
+			plugin, mixed, path = stack.pop()
+			if (plugin, mixed) in visited:
+				continue
+			visited.add((plugin, mixed))
+			for next, trace in self.__edges.get(plugin, ()):
+				if next == caller:
+					if mixed or trace != traceId:
+						return path + [next]
+				else:
+					stack.append((next, mixed or trace != traceId, path + [next]))
+		return None
+
+	def __expire(self, now):
+		"""
+		\brief Remove the calls whose callers gave up waiting, their result may never arrive
+		"""
+		while self.__deadlines and self.__deadlines[0][0] < now:
+			deadline, caller, id = heapq.heappop(self.__deadlines)
+			self.__drop((caller, id))
+
+	def __drop(self, key):
+		"""
+		\brief Remove a call and its edge, if it is still waiting
+		\param key The (caller, call id) of the call
+		"""
+		call = self.__calls.pop(key, None)
+		if call == None:
+			return
+		edges = self.__edges[key[0]]
+		edges[call] -= 1
+		if edges[call] == 0:
+			del edges[call]
+			if not edges:
+				del self.__edges[key[0]]
+
+	def remove(self, caller, id):
+		"""
+		\brief Remove a call whose result arrived
+		"""
+		self.__lock.acquire()
+		self.__drop((caller, id))
+		self.__lock.release()
+
+	def waits(self, caller, traceId):
+		"""
+		\brief Does the plugin wait for the result of a call of the trace?
+		\param caller The name of the plugin
+		\param traceId The trace
+		"""
+		self.__lock.acquire()
+		try:
+			return traceId != 0 and any(trace == traceId for callee, trace in self.__edges.get(caller, ()))
+		finally:
+			self.__lock.release()
+
+	def forget(self, name):
+		"""
+		\brief Remove the calls from and to an unloaded plugin
+		"""
+		self.__lock.acquire()
+		for key, (callee, traceId) in self.__calls.items():
+			if name in (key[0], callee):
+				self.__drop(key)
+		self.__lock.release()
 
 class PluginElement:
 	"""
@@ -272,8 +1160,315 @@ class PluginElement:
 		self.threads = threads #The threads of this plugin
 		self.process = process #The process instance of this plugin
 		self.req_lock = threading.Lock() #The request lock of this plugin
+		self.ans_lock = threading.Lock() #The lock for answers sent to this plugin
 		self.pipes = pipes #The communication pipes oft his plugin
 		self.listeners = {} #The event listeners to this plugin
+		self.dispatch = {} #The (listener, envelope header) deliveries of each event
 		self.fileName = fileName #The fileName of the plugin file
 		self.args = args #The initial args of this plugin
+		self.group = None #The names of all plugins in the process, if the plugin runs in a group
+		self.childPipes = () #The ends of the pipes for the plugin process
+		self.singleFlight = set() #The functions whose identical concurrent calls share one execution
+		self.stopping = False #Has the plugin been stopped while its process still finishes its jobs?
+
+class Router(object):
+	"""
+	\brief Multiplexes the pipes of all plugins in a single thread
+
+	The router waits on all pipes with epoll (or select where epoll is not available),
+	reads whatever arrived without blocking and cuts it into messages.
+	Outgoing messages are written without blocking as well,
+	what the pipe can not take right now waits in a send buffer of the connection.
+	The framing is the one of multiprocessing.Connection,
+	so the plugins keep using send_bytes and recv_bytes on their ends.
+
+	Each connection has a send buffer for each Priority, the more urgent messages are written first.
+
+	When the send buffer of a connection grows beyond the limit, the router stops reading
+	from the connection whose message was routed there, until the buffer is half empty again.
+	So a plugin that falls behind slows down its producers instead of filling the memory.
+	"""
+	__frame = struct.Struct('!i') #The length prefix of multiprocessing.Connection
+
+	def __init__(self, limit = 1 << 20):
+		"""
+		\brief Create the router
+		\param limit The number of bytes a send buffer may hold before the producers are paused
+		"""
+		self.__limit = limit
+		self.__reading = None #The connection whose messages are handled right now
+		self.__resumed = [] #The paused connections that may be read again
+		self.stalls = 0 #How often a producer was paused
+		self.__connections = {} #The state of each registered connection by file descriptor
+		self.__lock = threading.Lock() #Guards the connection states and send buffers
+		self.__wakeUp = os.pipe() #Interrupts the wait of the select fallback
+		if hasattr(select, 'epoll'):
+			self.__epoll = select.epoll()
+			self.__epoll.register(self.__wakeUp[0], select.EPOLLIN)
+		else:
+			self.__epoll = None
+		self.__running = True
+		self.__thread = threading.Thread(target = self.__run)
+		self.__thread.daemon = True
+
+	def start(self):
+		"""
+		\brief Start the router thread
+		"""
+		self.__thread.start()
+
+	def stop(self):
+		"""
+		\brief Stop the router thread
+		"""
+		self.__running = False
+		os.write(self.__wakeUp[1], 'w')
+		self.__thread.join()
+
+	def register(self, connection, handler):
+		"""
+		\brief Route the messages that arrive on the connection
+		\param connection The multiprocessing connection
+		\param handler Called in the router thread with each message that arrives
+		"""
+		fd = connection.fileno()
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.__lock.acquire()
+		try:
+			self.__connections[fd] = RouterConnection(connection, handler)
+			if self.__epoll != None:
+				self.__epoll.register(fd, select.EPOLLIN)
+		finally:
+			self.__lock.release()
+		self.__wake()
 
+	def unregister(self, connection):
+		"""
+		\brief Stop routing the connection
+		\param connection The multiprocessing connection
+		"""
+		self.__lock.acquire()
+		try:
+			self.__remove(connection.fileno())
+		finally:
+			self.__lock.release()
+
+	def send(self, connection, data, priority = Priority.NORMAL):
+		"""
+		\brief Send a message on the connection without blocking
+		\param connection The multiprocessing connection
+		\param data The message
+		\param priority The Priority of the message
+		\return False if the connection is not routed (any more)
+		"""
+		self.__lock.acquire()
+		try:
+			state = self.__connections.get(connection.fileno())
+			if state == None:
+				return False
+			chunk = self.__frame.pack(len(data)) + data
+			state.output[priority].append(chunk)
+			state.buffered += len(chunk)
+			if not state.wantsWrite:
+				self.__flush(state)
+			producer = self.__reading
+			if (state.buffered > self.__limit and producer != None and producer is not state 
+					and not producer.paused and threading.current_thread() is self.__thread):
+				producer.paused = True
+				state.stalled.append(producer)
+				self.stalls += 1
+				self.__watch(producer)
+			return True
+		finally:
+			self.__lock.release()
+
+	def __wake(self):
+		"""
+		\brief Make the router thread recompute what it waits for
+		"""
+		if self.__epoll == None:
+			os.write(self.__wakeUp[1], 'w')
+
+	def __remove(self, fd):
+		"""
+		\brief Forget the connection, the lock must be held
+		"""
+		state = self.__connections.pop(fd, None)
+		if state != None:
+			if self.__epoll != None:
+				self.__epoll.unregister(fd)
+			self.__resume(state)
+
+	def __resume(self, state):
+		"""
+		\brief Read again from the producers that were paused because of the connection, the lock must be held
+		\param state The RouterConnection that drained
+		"""
+		if len(state.stalled) == 0:
+			return
+		for producer in state.stalled:
+			producer.paused = False
+			self.__watch(producer)
+		self.__resumed.extend(state.stalled)
+		del state.stalled[:]
+		if threading.current_thread() is not self.__thread:
+			os.write(self.__wakeUp[1], 'w')
+
+	def __flush(self, state):
+		"""
+		\brief Write as much of the send buffer as the pipe takes, the lock must be held
+		\param state The RouterConnection to flush
+		"""
+		try:
+			while True:
+				if state.writing == None:
+					for lane in state.output:
+						if len(lane) > 0:
+							state.writing = lane.popleft()
+							break
+					else:
+						break
+				chunk = state.writing
+				written = os.write(state.fd, buffer(chunk, state.written))
+				state.written += written
+				if state.written < len(chunk):
+					break
+				state.writing = None
+				state.buffered -= len(chunk)
+				state.written = 0
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				print('Router could not write to ' + str(state.fd) + ': ' + str(e))
+				self.__remove(state.fd)
+				return
+		if len(state.stalled) > 0 and state.buffered <= self.__limit / 2:
+			self.__resume(state)
+		wantsWrite = state.writing != None
+		if wantsWrite != state.wantsWrite:
+			state.wantsWrite = wantsWrite
+			self.__watch(state)
+
+	def __watch(self, state):
+		"""
+		\brief Wait for what the connection is ready for, the lock must be held
+		\param state The RouterConnection whose wishes changed
+		"""
+		if self.__epoll != None:
+			if state.fd in self.__connections:
+				self.__epoll.modify(state.fd, (not state.paused and select.EPOLLIN or 0) 
+									| (state.wantsWrite and select.EPOLLOUT or 0))
+		else:
+			self.__wake()
+
+	def __read(self, state):
+		"""
+		\brief Read what arrived on the connection and handle all complete messages
+		\param state The RouterConnection to read from
+		"""
+		try:
+			data = os.read(state.fd, 65536)
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			data = ''
+		if len(data) == 0:
+			self.unregister(state.connection)
+			return
+		state.input.extend(data)
+		self.__handle(state)
+
+	def __handle(self, state):
+		"""
+		\brief Handle the complete messages that were read from the connection
+		\param state The RouterConnection
+
+		Stops when the connection gets paused, the rest is handled when it resumes.
+		"""
+		self.__reading = state
+		offset = 0
+		available = len(state.input)
+		while available - offset >= self.__frame.size:
+			size = self.__frame.unpack_from(state.input, offset)[0]
+			end = offset + self.__frame.size + size
+			if end > available:
+				break
+			message = str(state.input[offset + self.__frame.size:end])
+			offset = end
+			try:
+				state.handler(message)
+			except Exception:
+				traceback.print_exc()
+			if state.paused:
+				break
+		self.__reading = None
+		del state.input[:offset]
+
+	def __poll(self):
+		"""
+		\brief Wait until some connections can be read or written
+		\return The list of (fd, readable, writable)
+		"""
+		if self.__epoll != None:
+			return [(fd, events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR), 
+						events & select.EPOLLOUT) for fd, events in self.__epoll.poll()]
+		self.__lock.acquire()
+		reading = [fd for fd, state in self.__connections.items() if not state.paused] + [self.__wakeUp[0]]
+		writing = [fd for fd, state in self.__connections.items() if state.wantsWrite]
+		self.__lock.release()
+		readable, writable, _ = select.select(reading, writing, [])
+		return ([(fd, True, False) for fd in readable] + [(fd, False, True) for fd in writable])
+
+	def __run(self):
+		"""
+		\brief The loop of the router thread
+		"""
+		while self.__running:
+			try:
+				events = self.__poll()
+			except (IOError, OSError, select.error) as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			for fd, readable, writable in events:
+				if fd == self.__wakeUp[0]:
+					os.read(fd, 4096)
+					continue
+				state = self.__connections.get(fd)
+				if state == None:
+					continue
+				if writable:
+					self.__lock.acquire()
+					try:
+						self.__flush(state)
+					finally:
+						self.__lock.release()
+				if readable:
+					if state.paused:
+						#only a hang up is reported for a paused connection
+						self.unregister(state.connection)
+					else:
+						self.__read(state)
+			self.__lock.acquire()
+			resumed = self.__resumed
+			self.__resumed = []
+			self.__lock.release()
+			for state in resumed:
+				if not state.paused and state.fd in self.__connections:
+					self.__handle(state)
+
+class RouterConnection(object):
+	"""
+	\brief The state of one connection in the Router
+	"""
+	def __init__(self, connection, handler):
+		self.connection = connection #The multiprocessing connection
+		self.fd = connection.fileno() #The file descriptor of the connection
+		self.handler = handler #The handler for arriving messages
+		self.input = bytearray() #The received bytes that do not form a complete message yet
+		self.output = [collections.deque() for i in xrange(Priority.LEVELS)] #The framed messages that wait to be written by priority
+		self.writing = None #The framed message that is written right now
+		self.written = 0 #How much of the message in writing is already written
+		self.wantsWrite = False #Is the router waiting until the connection can be written?
+		self.buffered = 0 #The number of bytes in output
+		self.paused = False #Is reading stopped until the connections this one sent to drained?
+		self.stalled = [] #The connections that are paused until this one drained
@@ -23,6 +23,13 @@ class Records(PluginInterface):
         self.__locals = [] #The local records on the current map
         self.__currentMapId = None #The database id of the current map 
         
+    @staticmethod
+    def getDependencies(args):
+        """
+        \brief The plugins that have to be ready before this one is initialized
+        """
+        return ['TmConnector', 'Maps']
+
     def initialize(self, args):
         """
         \brief Initialize the plugin
@@ -57,6 +64,7 @@ class Records(PluginInterface):
         self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'EndMap', 'onEndMap')
         self.callMethod((None, 'subscribeEvent'), 'TmConnector', 'BeginMap', 'onBeginMap')
         self.callMethod((None, 'subscribeEvent'), 'Records', 'newRecord', 'onNewRecord')
+        self.subscribeState('Maps', 'onMapsChanged')
         self.__retrieveCurrentMapId()
         self.__getCurrentRecords()
         
@@ -229,11 +237,24 @@ class Records(PluginInterface):
         self.__retrieveCurrentMapId()
         self.__getCurrentRecords()
         
+    def onMapsChanged(self, plugin, key):
+        """
+        \brief Callback for changes of the state the Maps plugin shares
+        \param plugin The name of the plugin ('Maps')
+        \param key The key of the changed value
+        
+        BeginMap may be processed before Maps published the new map, so the records are reloaded
+        once the id of the current map changed.
+        """
+        if key == 'currentMapId' and self.getState('Maps', 'currentMapId') != self.__currentMapId:
+            self.__retrieveCurrentMapId()
+            self.__getCurrentRecords()
+        
     def __retrieveCurrentMapId(self):
         """
-        \brief Retrieve the database id of the current map
+        \brief Retrieve the database id of the current map from the local copy of the state of Maps
         """
-        self.__currentMapId = self.callFunction(('Maps', 'getCurrentMapId'))
+        self.__currentMapId = self.getState('Maps', 'currentMapId')
         
     def __updateRankingsInDatabase(self):
         """
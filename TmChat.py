@@ -22,6 +22,13 @@ class TmChat(PluginInterface):
 		self.commands = {}
 		super(TmChat, self).__init__(pipes)
 
+	@staticmethod
+	def getDependencies(args):
+		"""
+		\brief The plugins that have to be ready before this one is initialized
+		"""
+		return ['TmConnector']
+
 	def initialize(self, args):
 		"""
 		\brief Initialize the plugin
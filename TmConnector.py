@@ -5,17 +5,123 @@ import xmlrpclib
 import os
 import functools
 import xml.parsers.expat
+import time
+import Queue
+
+class Multicall(object):
+	"""
+	\brief Collects the calls to the dedicated server and sends them as one system.multicall
+
+	The calls made within a short window after the first one are sent together,
+	so a burst of calls, e.g. a manialink to every player, costs one round trip.
+	The batches are sent in the order the calls were made,
+	the server answers the calls of a batch one after another.
+	"""
+	def __init__(self, client, window = 0.002, limit = 100):
+		"""
+		\param client The connected Gbx.PipelinedClient
+		\param window The seconds to wait for more calls after the first one
+		\param limit The most calls in one batch
+		"""
+		self.__client = client
+		self.__window = window
+		self.__limit = limit
+		self.__calls = [] #The (name, args, future) of the calls to send
+		self.__flush = False #Send the calls without waiting for the window?
+		self.__arrived = threading.Condition()
+		self.__sent = Queue.Queue() #The (wait for the results, futures) of the batches on their way
+		for target in (self.__send, self.__receive):
+			thread = threading.Thread(target = target)
+			thread.daemon = True
+			thread.start()
+
+	def call(self, name, args, onAnswer = None):
+		"""
+		\brief Make a call in the next batch
+		\param name The name of the XML-RPC method
+		\param args The tuple of arguments
+		\param onAnswer Called with the Future when the result arrived
+		\return The Future of the result, a failed call raises its xmlrpclib.Fault
+		"""
+		return self.callGroup([(name, args)], False, onAnswer)[0]
+
+	def callGroup(self, calls, flush = True, onAnswer = None):
+		"""
+		\brief Make several calls together
+		\param calls The list of (name, args) of the calls
+		\param flush Send them right away instead of waiting for more calls?
+		\param onAnswer Called with the Future of a call when its result arrived
+		\return The list of the Futures of the results
+		"""
+		futures = []
+		for call in calls:
+			future = Future()
+			future.onAnswer = onAnswer and functools.partial(onAnswer, future)
+			futures.append(future)
+		self.__arrived.acquire()
+		self.__calls.extend((name, args, future) for (name, args), future in zip(calls, futures))
+		self.__flush = self.__flush or flush
+		self.__arrived.notify()
+		self.__arrived.release()
+		return futures
+
+	def __send(self):
+		"""
+		\brief Send the collected calls in batches
+		"""
+		while True:
+			self.__arrived.acquire()
+			while len(self.__calls) == 0:
+				self.__arrived.wait()
+			flush = self.__flush
+			self.__arrived.release()
+			if not flush:
+				#a timed wait on the condition would poll in steps of up to 50 ms
+				time.sleep(self.__window)
+			self.__arrived.acquire()
+			try:
+				calls = self.__calls[:self.__limit]
+				del self.__calls[:self.__limit]
+				self.__flush = self.__flush and len(self.__calls) > 0
+			finally:
+				self.__arrived.release()
+			try:
+				wait = self.__client.send_multicall([(name, args) for name, args, future in calls])
+			except Exception as e:
+				wait = functools.partial(self.__raise, e)
+			self.__sent.put((wait, [future for name, args, future in calls]))
+
+	def __raise(self, error):
+		raise error
+
+	def __receive(self):
+		"""
+		\brief Hand the results of the batches to the callers
+		"""
+		while True:
+			wait, futures = self.__sent.get()
+			try:
+				results = [isinstance(result, dict) 
+							and LocalResult(xmlrpclib.Fault(result['faultCode'], result['faultString']), True)
+							or LocalResult(result[0]) for result in wait()]
+			except Exception as e:
+				results = [LocalResult(e, True)] * len(futures)
+			for future, result in zip(futures, results):
+				future.setAnswer(result)
 
 class TmConnector(PluginInterface):
 	def __init__(self, pipes, args):
 		self.listener = Gbx.Client(args[0])
-		self.questioner = Gbx.Client(args[0])
+		self.questioner = Gbx.PipelinedClient(args[0]) #Takes the requests of all workers at the same time
 		self.args = args
-		super(TmConnector, self).__init__(pipes)
+		#the calls of different plugins are in flight at once, those of one plugin stay in order
+		super(TmConnector, self).__init__(pipes, workers = 8, orderingKey = orderByQuestioner)
 
 	def initialize(self, args):
 		self.startListener()
 		self.startQuestioner()
+		#many plugins ask for the players at once on BeginMap and PlayerConnect
+		self.callMethod((None, 'enableSingleFlight'), 'GetPlayerList')
 		self.t_id = threading.Thread(target = self.__Poll)
 		self.t_id.start()
 
@@ -24,12 +130,14 @@ class TmConnector(PluginInterface):
 		self.listener.Authenticate(self.args[1], self.args[2])
 		self.listener.EnableCallbacks(True)
 		self.listener.set_default_method(self.__default_callback)
+		self.listener.set_callback_filter(self.__isListened)
 		self.listener.SetApiVersion("2011-10-06")
 
 	def startQuestioner(self):
 		self.questioner.init()
 		self.questioner.Authenticate(self.args[1], self.args[2])
 		self.listener.SetApiVersion("2011-10-06")
+		self.__multicall = Multicall(self.questioner)
 
 	def __Poll(self):
 		while True:
@@ -40,21 +148,60 @@ class TmConnector(PluginInterface):
 			except xmlrpclib.Fault as f:
 				self.callMethod(('Logger','log'), 'Error: ' + str(f))
 
+	def __isListened(self, callback):
+		"""
+		\brief Does any plugin listen to the event of a callback?
+		\param callback The name of the callback, e.g. TrackMania.PlayerCheckpoint
+		\return False if the callback can be skipped before its parameters are decoded
+		"""
+		name = callback.split('.')[1]
+		if self.hasListeners(name) or self.hasListeners('defaultCallback'):
+			return True
+		self.metrics.count('tmc_callbacks_skipped_total', (('callback', name),))
+		return False
+
 	def __default_callback(self, *args):
 		name = args[0].split('.')[1]
 		self.signalEvent(name, *args[1:])
 		self.signalEvent("defaultCallback", name, *args[1:])
 
 	def __getattr__(self, name):
-		attr = functools.partial(self.__wrapper, getattr(self.questioner, name))
+		attr = functools.partial(self.__wrapper, name)
 		return attr
 
-	def __wrapper(self, function, *args):
+	def multicall(self, calls):
+		"""
+		\brief Make several calls to the dedicated server in one system.multicall
+		\param calls The list of (method name, args tuple) of the calls
+		\return The list of the results, None for the calls that failed
+		"""
+		futures = self.__multicall.callGroup(calls)
+		return [self.__result(name, args, future) for (name, args), future in zip(calls, futures)]
+
+	def __wrapper(self, name, *args):
+		"""
+		\brief Make a call to the dedicated server in the next system.multicall
+		\param name The name of the XML-RPC method
+		\param args The arguments
+
+		A method returns right away, so the worker can add the next call of a burst to the same batch.
+		A function call is sent at once with the calls that are collected already.
+		"""
+		if not self.callerWaits():
+			self.__multicall.call(name, args, functools.partial(self.__result, name, args))
+			return None
+		#the caller waits, so the call goes with the calls collected so far instead of waiting for more
+		return self.__result(name, args, self.__multicall.callGroup([(name, args)])[0])
+
+	def __result(self, name, args, future):
+		"""
+		\brief Wait for the result of a call and log its error
+		\return The result or None if the call failed
+		"""
 		try:
-			result = function(*args)
-			return result
+			return future.result()
 		except (xml.parsers.expat.ExpatError, Gbx.ProtocolError, Gbx.ConnectionError) as e:
-			self.callMethod(('Logger','log'), 'Error('+str(e)+'): Called method ' + str(function) + \
+			self.callMethod(('Logger','log'), 'Error('+str(e)+'): Called method ' + str(name) + \
 								' with args ' + str(args) + os.linesep +\
 								'Restarting Gbx.Client')
 			return None
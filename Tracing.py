@@ -0,0 +1,85 @@
+import itertools
+import json
+import os
+
+"""
+\file Tracing.py
+\brief Spans of the requests between the plugins in the Chrome trace event format
+
+Every request carries the id of its trace and the id of its span.
+A request made while a job is processed belongs to the trace of the job,
+so a chat command can be followed through all the plugins it reaches.
+The spans of all processes are appended to one file, which can be opened
+in chrome://tracing or ui.perfetto.dev.
+"""
+
+_spanIds = itertools.count(1) #The source of the span ids of this process
+
+def newSpanId():
+	"""
+	\brief Create an id for a trace or a span
+	\return The id, unique over all processes while their process ids are not reused
+	"""
+	return (os.getpid() << 31) | (next(_spanIds) & 0x7fffffff)
+
+def createTraceFile(fileName):
+	"""
+	\brief Start an empty trace file
+	\param fileName The name of the file, an existing file is replaced
+
+	The file is in the JSON array format without the closing bracket,
+	which the trace viewers accept, so the processes can append to it until they exit.
+	"""
+	with open(fileName, 'w') as traceFile:
+		traceFile.write('[\n')
+
+class Tracer(object):
+	"""
+	\brief Appends the spans of one plugin to the trace file
+	"""
+	def __init__(self, fileName, processName):
+		"""
+		\brief Open the trace file
+		\param fileName The trace file created by createTraceFile
+		\param processName The name to show for this process
+		"""
+		self.__fd = os.open(fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		self.__pid = os.getpid()
+		self.__write({'name' : 'process_name', 'ph' : 'M', 'pid' : self.__pid, 'tid' : 0,
+					'args' : {'name' : processName}})
+
+	def __write(self, event):
+		#a single write on a file opened for appending is not interleaved with the other processes
+		os.write(self.__fd, json.dumps(event, separators = (',', ':')) + ',\n')
+
+	def span(self, name, thread, start, duration, traceId, spanId, args):
+		"""
+		\brief Record a processed request
+		\param name The name of the span, e.g. Plugin.method
+		\param thread The id of the thread that processed it
+		\param start The time.time() the processing started
+		\param duration The duration in seconds
+		\param traceId The id of the trace the request belongs to
+		\param spanId The id of the span, the request ends the flow with this id, 0 if it has none
+		\param args Additional values to show with the span
+		"""
+		args['trace'] = '%x' % traceId
+		args['span'] = '%x' % spanId
+		self.__write({'name' : name, 'cat' : 'request', 'ph' : 'X', 'pid' : self.__pid, 'tid' : thread,
+					'ts' : int(start * 1e6), 'dur' : int(duration * 1e6), 'args' : args})
+		if spanId:
+			self.__write({'name' : 'call', 'cat' : 'request', 'ph' : 'f', 'bp' : 'e', 'pid' : self.__pid,
+						'tid' : thread, 'ts' : int(start * 1e6), 'id' : '%x' % spanId})
+
+	def flow(self, thread, start, spanId):
+		"""
+		\brief Record that a request was sent from the current span
+		\param thread The id of the sending thread
+		\param start The time.time() the request was sent
+		\param spanId The span id of the request
+		"""
+		self.__write({'name' : 'call', 'cat' : 'request', 'ph' : 's', 'pid' : self.__pid, 'tid' : thread,
+					'ts' : int(start * 1e6), 'id' : '%x' % spanId})
+
+	def close(self):
+		os.close(self.__fd)